@@ -8,6 +8,7 @@ from pyramid.request import Request
 from pyramid.security import unauthenticated_userid
 from pyramid.httpexceptions import HTTPUnauthorized, HTTPInternalServerError
 from pyramid.exceptions import NotFound
+from pyramid.settings import asbool
 
 from webassets import Bundle
 
@@ -25,6 +26,8 @@ from pycchdo.util import (
 from pycchdo.routes import configure_routes
 from pycchdo.models.serial import DBSession, Person
 from pycchdo.models.search import SearchIndex
+from pycchdo.models.tracks import TrackIndex
+from pycchdo.models.tiles import TrackTiles
 from pycchdo.models.filestorage import FSStore
 from pycchdo.views.datacart import get_datacart
 
@@ -41,6 +44,14 @@ class RequestFactory(Request):
     def search_index(self):
         return self.registry.settings['db.search_index']
 
+    @reify
+    def track_index(self):
+        return self.registry.settings['db.track_index']
+
+    @reify
+    def track_tiles(self):
+        return self.registry.settings['db.track_tiles']
+
     @reify
     def models(self):
         return models
@@ -121,7 +132,12 @@ def create_config(settings):
     session_factory = UnencryptedCookieSessionFactoryConfig(
         settings['key_session_factory'])
 
-    settings['db.search_index'] = SearchIndex(settings['search_index_path'])
+    settings['db.search_index'] = SearchIndex(
+        settings['search_index_path'],
+        queue=asbool(settings.get('search_index_queue', False)))
+    settings['db.track_index'] = TrackIndex()
+    settings['db.track_tiles'] = TrackTiles(
+        settings['db.track_index'], settings.get('track_tiles_path'))
 
     return Configurator(
         settings=settings,
@@ -11,8 +11,6 @@ from os.path import (
     )
 from zipfile import BadZipfile
 
-import transaction
-
 import webhelpers.html as whh
 H = whh.HTML
 from webhelpers.html import tags, tools as whhtools
@@ -201,18 +199,18 @@ def reduce_specificity(request, *cruises):
     if has_mod(request):
         return
 
-    now = datetime.now()
-    for cruise in cruises:
-        if needs_specifics_reduction(cruise, now):
-            log.info(u'Reducing specifics for cruise {0}'.format(cruise))
-            attr = cruise.get('date_start')
-            if attr:
-                cruise.date_start = datetime(attr.year, 1, 1)
-                transaction.doom()
-            attr = cruise.get('date_end')
-            if attr:
-                cruise.date_end = datetime(attr.year, 1, 1)
-                transaction.doom()
+    Cruise.reduce_specifics(cruises)
+
+
+def all_reduced_specificity(request, query):
+    """Run a query for Cruises, removing specifics as in reduce_specificity.
+
+    The reduced dates are selected by the query itself.
+
+    """
+    if has_mod(request):
+        return query.all()
+    return Cruise.all_reduced_specifics(query)
 
 
 def get_visible_notes(request, attr):
@@ -708,6 +706,9 @@ def cruise_listing(request, cruises, pre_expand=False, allow_empty=False,
     cruises = filter(None, cruises)
     if not cruises and not allow_empty:
         return ''
+    Cruise.prefetch_attrs(cruises, ['map_thumb'])
+    if show_data:
+        Cruise.prefetch_file_attrs(cruises)
 
     sorter = Sorter(request.params.get('orderby', ''))
     headers = [
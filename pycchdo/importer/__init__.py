@@ -7,6 +7,8 @@ from os import (geteuid, seteuid, setegid)
 from pwd import getpwnam
 import sys
 
+import transaction
+
 from pyramid.paster import get_appsettings
 
 from sqlalchemy import engine_from_config
@@ -15,7 +17,7 @@ from sqlalchemy.orm import lazyload
 from libcchdo.datadir.dl import AFTP, SFTP, pushd, lock, su
 
 from pycchdo.models.serial import (
-    Change, Note,
+    Change, Note, Obj, Cruise,
     store_context, DBSession, reset_database, reset_fs, 
     log as model_log,
     )
@@ -291,6 +293,18 @@ def do_import():
             if not args.skip_seahunt:
                 seahunt.import_(wwwuser.pw_gid, args)
 
+        # The importer backdates judgment times and modifies Changes directly
+        # so the stored modification times and current attrs need to be
+        # recalculated.
+        log.info(u'backfilling modification times')
+        Obj.backfill_mtime()
+        log.info(u'rebuilding current attrs')
+        Obj.rebuild_current_attrs()
+        Cruise.rebuild_data_updates()
+        Cruise.rebuild_identifiers()
+        Cruise.rebuild_tracks()
+        transaction.commit()
+
     if not args.skip_search_index:
         log.info("indexing...")
         SearchIndex(args.search_index_path).rebuild_index(
@@ -1,8 +1,25 @@
 from string import capwords
+from collections import namedtuple
 
 from webob.multidict import MultiDict
 
 
+class AttrSchema(namedtuple('AttrSchema', [
+        'key', 'type', 'name', 'serializer', 'deserializer', 'model',
+        'is_file', 'is_status'])):
+    """The compiled definition of an allowed attr."""
+    __slots__ = ()
+
+
+class FrozenDict(dict):
+    """A dict that may not be modified after creation."""
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(u'{0} is immutable'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
 class AllowableMgr(object):
     """Limit the allowable attributes for a given object.
 
@@ -12,6 +29,7 @@ class AllowableMgr(object):
 
     """
     __allowed_attrs_by_cls = {}
+    __attr_schemas_by_cls = {}
 
     @classmethod
     def _attr_type_to_str(cls, attr_type):
@@ -41,6 +59,62 @@ class AllowableMgr(object):
                 allowed_attrs.update(c._allowed_attrs())
         return allowed_attrs
 
+    @classmethod
+    def _compile_attr_schema(cls, key, attrdef):
+        """Compile an attr definition into an AttrSchema."""
+        return AttrSchema(
+            key, attrdef['type'], attrdef['name'], attrdef.get('serializer'),
+            attrdef.get('deserializer'), attrdef.get('model'), False, False)
+
+    @classmethod
+    def _attr_schemas(cls):
+        """Return the compiled attr schemas for this class.
+
+        Unlike _allowed_attrs, the schemas are only merged with the base
+        classes' once and the result is kept until another attr is allowed.
+
+        """
+        try:
+            return cls.__attr_schemas_by_cls[cls]
+        except KeyError:
+            pass
+        schemas = {}
+        for base in reversed(cls.__bases__):
+            if issubclass(base, AllowableMgr):
+                schemas.update(base._attr_schemas())
+        for key, attrdef in cls._allowed_attrs_dict().items():
+            schemas[key] = cls._compile_attr_schema(key, attrdef)
+        schemas = cls.__attr_schemas_by_cls[cls] = FrozenDict(schemas)
+        return schemas
+
+    @classmethod
+    def _attr_schema(cls, key):
+        """Return the compiled attr schema for key.
+
+        Raises: ValueError if key is not allowed.
+
+        """
+        try:
+            return cls._attr_schemas()[key]
+        except KeyError:
+            raise ValueError(u'key {0} is not allowed for {1}'.format(key, cls))
+
+    @classmethod
+    def _invalidate_attr_schemas(cls):
+        """Drop all compiled attr schemas.
+
+        Subclasses inherit their bases' schemas so all of them are dropped.
+
+        """
+        AllowableMgr.__attr_schemas_by_cls.clear()
+
+    @classmethod
+    def finalize_attr_schemas(cls):
+        """Compile the attr schemas for this class and all its subclasses."""
+        cls._attr_schemas()
+        for subclass in cls.__subclasses__():
+            subclass.finalize_attr_schemas()
+
     @classmethod
     def _update_allowed_attrs_caches(cls):
         """Update the attr caches."""
@@ -87,6 +161,7 @@ class AllowableMgr(object):
         except KeyError:
             pass
         attrs[key] = d
+        cls._invalidate_attr_schemas()
         if not batch:
             cls._update_allowed_attrs_caches()
 
@@ -100,8 +175,4 @@ class AllowableMgr(object):
     @classmethod
     def attr_type(cls, key):
         """Return the type of data allowed for key."""
-        attrs = cls._allowed_attrs()
-        try:
-            return attrs[key]['type']
-        except KeyError:
-            raise ValueError(u'key {0} is not allowed for {1}'.format(key, cls))
+        return cls._attr_schema(key).type
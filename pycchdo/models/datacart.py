@@ -10,7 +10,7 @@ class Datacart(OrderedSet):
 
     """
     def files(self):
-        return Change.get_all_by_ids(*list(self))
+        return Change.resolve_values(Change.get_all_by_ids(*list(self)))
 
     @classmethod
     def is_file_type_allowed(cls, ftype):
@@ -7,12 +7,20 @@ Fully re-indexing is also supported via rebuild_index.
 """
 import os
 from datetime import datetime
+from multiprocessing import Pool, cpu_count
 from contextlib import contextmanager
 from re import compile as re_compile
 from traceback import format_exc
 from functools import wraps
+from threading import Lock, local
 
-from sqlalchemy.orm import noload, joinedload, subqueryload, lazyload
+from sqlalchemy import event, Column, Integer, String
+from sqlalchemy.orm import (
+    noload, joinedload, subqueryload, object_session)
+
+from zope.sqlalchemy import mark_changed
+
+import transaction
 
 from whoosh import index
 from whoosh.analysis import *
@@ -33,7 +41,7 @@ DETAIL = int(DEBUG / 2)
 
 
 from pycchdo.models.serial import (
-    DBSession,
+    DBSession, Session, Base,
     Cruise, Person, Ship, Country, Institution, Collection, Note,
     )
 
@@ -342,14 +350,110 @@ class IndexerVisitor(object):
 indexer_visitor = IndexerVisitor()
 
 
+REBUILD_CHUNK_SIZE = 500
+
+
+def _chunks(ids, size):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+class IndexUpdates(object):
+    """Index updates collected during a transaction.
+
+    Updates are coalesced so that each document is written at most once, with
+    the last operation on it.
+
+    """
+    SAVE = 'save'
+    REMOVE = 'remove'
+
+    def __init__(self):
+        self.ops = {}
+        self.docs = None
+
+    def add(self, name, id, op):
+        self.ops[(name, id)] = op
+
+    def by_index(self):
+        """Return {index name: {op: [ids]}}."""
+        by_name = {}
+        for (name, id), op in self.ops.items():
+            by_name.setdefault(name, {}).setdefault(op, []).append(id)
+        return by_name
+
+
+class _IndexJob(Base):
+    """A queued index update for the indexer process.
+
+    Jobs are written in the same transaction as the change they index, so they
+    exist exactly when the change was committed.
+
+    """
+    __tablename__ = 'search_index_jobs'
+
+    id = Column(Integer, primary_key=True)
+    index_name = Column(String(16), nullable=False)
+    doc_id = Column(Integer, nullable=False)
+    op = Column(String(8), nullable=False)
+
+
+_UPDATES_KEY = 'search_index_updates'
+
+
+def _session_updates(session, search_index):
+    updates = session.info.setdefault(_UPDATES_KEY, {})
+    try:
+        return updates[search_index]
+    except KeyError:
+        return updates.setdefault(search_index, IndexUpdates())
+
+
+@event.listens_for(Session, 'before_commit')
+def _build_index_docs(session):
+    """Build the documents while the changes can still be read."""
+    # Changes still pending may queue more updates.
+    session.flush()
+    for search_index, updates in session.info.get(_UPDATES_KEY, {}).items():
+        if search_index.queue:
+            search_index._enqueue(session, updates)
+        else:
+            updates.docs = search_index._build_docs(session, updates)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_index_updates(session):
+    for search_index, updates in session.info.pop(_UPDATES_KEY, {}).items():
+        if updates.docs is not None:
+            search_index._write_docs(updates.docs)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_index_updates(session):
+    session.info.pop(_UPDATES_KEY, None)
+
+
 class SearchIndex(object):
-    """Encapsulates a directory that is used as a Whoosh search index."""
+    """Encapsulates a directory that is used as a Whoosh search index.
+
+    queue - if True, index updates are queued in the database for the indexer
+        process (pycchdo_search_indexer) instead of being written by this
+        process
+
+    Searches reuse the open indexes and a searcher per index and thread. A
+    searcher is refreshed when the index generation has changed.
+
+    """
     index_dir = '.'
     index_dir_checked_exists = False
 
-    def __init__(self, index_dir=None):
+    def __init__(self, index_dir=None, queue=False):
         if index_dir is not None:
             self.index_dir = index_dir
+        self.queue = queue
+        self._indexes = {}
+        self._indexes_lock = Lock()
+        self._local = local()
         self._ensure_index_dir()
         self.register_triggers()
 
@@ -430,13 +534,62 @@ class SearchIndex(object):
                     ixw.close()
                 ix.close()
 
+    def _open_index(self, name):
+        """Return the long-lived Index for name."""
+        with self._indexes_lock:
+            try:
+                return self._indexes[name]
+            except KeyError:
+                ix = self._indexes[name] = self.open_or_create_index(name)
+                return ix
+
+    def _pooled_searcher(self, name):
+        """Return this thread's searcher for name, refreshed if needed."""
+        try:
+            searchers = self._local.searchers
+        except AttributeError:
+            searchers = self._local.searchers = {}
+        searcher = searchers.get(name)
+        if searcher is None:
+            searcher = self._open_index(name).searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
+        searchers[name] = searcher
+        return searcher
+
     @contextmanager
     def searcher(self, index_name, index=None):
         if index is None:
-            index = self.open_or_create_index(index_name)
+            yield self._pooled_searcher(index_name)
+            return
         with index.searcher() as searcher:
             yield searcher
 
+    def _obj_doc(self, obj):
+        """Return the document for an obj or None if it cannot be made."""
+        try:
+            doc = obj.accept_visitor(indexer_visitor)
+        except Exception as exc:
+            log.error(repr(exc))
+            return None
+        doc['mtime'] = obj.mtime
+        doc['id'] = _model_id_to_index_id(obj.id)
+        return doc
+
+    def _note_doc(self, note):
+        doc = {}
+        if note.body:
+            doc['body'] = unicode(note.body)
+        if note.action:
+            doc['action'] = unicode(note.action)
+        if note.data_type:
+            doc['data_type'] = unicode(note.data_type)
+        if note.subject:
+            doc['subject'] = unicode(note.subject)
+        doc['mtime'] = note.ts_c
+        doc['id'] = _model_id_to_index_id(note.id)
+        return doc
+
     def save_obj(self, obj, writer=None):
         try:
             obj.id
@@ -450,17 +603,45 @@ class SearchIndex(object):
                 log.warn(u'Could not open index for {0}'.format(name))
                 return
 
-            try:
-                doc = obj.accept_visitor(indexer_visitor)
-            except Exception as exc:
-                log.error(repr(exc))
-                ixw.cancel()
+            doc = self._obj_doc(obj)
+            if doc is None:
+                # A shared writer belongs to the caller.
+                if not writer:
+                    ixw.cancel()
             else:
-                doc['mtime'] = obj.mtime
-                doc['id'] = _model_id_to_index_id(obj.id)
                 log.log(DETAIL, u'saving {0} {1!r}'.format(name, doc))
                 ixw.update_document(**doc)
 
+    def _objs_by_index(self, objs):
+        by_name = {}
+        for obj in objs:
+            by_name.setdefault(obj.obj_type.lower(), []).append(obj)
+        return by_name
+
+    def save_objs(self, objs):
+        """Save many objs with one writer per index."""
+        for name, objs in self._objs_by_index(objs).items():
+            if name not in _schemas.keys():
+                continue
+            with self.writer(name) as ixw:
+                if ixw is None:
+                    log.warn(u'Could not open index for {0}'.format(name))
+                    continue
+                for obj in objs:
+                    self.save_obj(obj, ixw)
+
+    def remove_objs(self, objs):
+        """Remove many objs with one writer per index."""
+        for name, objs in self._objs_by_index(objs).items():
+            if name not in _schemas.keys():
+                continue
+            with self.writer(name) as ixw:
+                if ixw is None:
+                    log.warn(u'Unable to unindex objs {0!r}'.format(objs))
+                    continue
+                for obj in objs:
+                    self.remove_obj(obj, ixw)
+
     def save_note(self, note, writer=None):
         try:
             note.id
@@ -470,17 +651,7 @@ class SearchIndex(object):
             if ixw is None:
                 log.warn(u'Could not open index for note')
                 return
-            doc = {}
-            if note.body:
-                doc['body'] = unicode(note.body)
-            if note.action:
-                doc['action'] = unicode(note.action)
-            if note.data_type:
-                doc['data_type'] = unicode(note.data_type)
-            if note.subject:
-                doc['subject'] = unicode(note.subject)
-            doc['mtime'] = note.ts_c
-            doc['id'] = _model_id_to_index_id(note.id)
+            doc = self._note_doc(note)
             log.debug(u'saving {0!r}'.format(doc))
             ixw.update_document(**doc)
 
@@ -499,88 +670,266 @@ class SearchIndex(object):
                 return
             ixw.delete_by_term('id', _model_id_to_index_id(note.id))
 
-    def _clean_index(self, ixw, model, indexed_ids, to_index):
-        ixs = ixw.searcher()
-
+    def _queue(self, name, target, op):
+        """Record an index update for the transaction target is in."""
+        if name not in _schemas:
+            return
         try:
-            # Walk each index
-            for fields in ixs.all_stored_fields():
-                indexed_id = fields['id']
-                indexed_ids.add(int(indexed_id))
+            target_id = target.id
+        except AttributeError:
+            return
+        session = object_session(target) or DBSession()
+        _session_updates(session, self).add(name, target_id, op)
 
-            id_objs = {}
-            objs = model.query().options(
-                lazyload('*')).filter(model.id.in_(indexed_ids)).all()
-            for obj in objs:
-                id_objs[obj.id] = obj
+    def queue_save_obj(self, obj):
+        self._queue(obj.obj_type.lower(), obj, IndexUpdates.SAVE)
+
+    def queue_remove_obj(self, obj):
+        self._queue(obj.obj_type.lower(), obj, IndexUpdates.REMOVE)
+
+    def queue_save_objs(self, objs):
+        for obj in objs:
+            self.queue_save_obj(obj)
+
+    def queue_remove_objs(self, objs):
+        for obj in objs:
+            self.queue_remove_obj(obj)
+
+    def queue_save_note(self, note):
+        self._queue('note', note, IndexUpdates.SAVE)
 
-            for indexed_id in indexed_ids:
-                log.debug('Check existance {0} {1}'.format(model, indexed_id))
+    def queue_remove_note(self, note):
+        self._queue('note', note, IndexUpdates.REMOVE)
 
-                obj = id_objs.get(indexed_id, None)
-                if not obj:
-                    # for missing docs
-                    log.debug('Remove missing id %s' % indexed_id)
-                    ixw.delete_by_term('id', unicode(indexed_id))
+    def _build_docs(self, session, updates):
+        """Build the documents for the updates.
+
+        Returns {index name: [(id, doc)]} where a doc of None removes the id.
+
+        """
+        docs = {}
+        for name, ops in updates.by_index().items():
+            name_docs = docs.setdefault(name, [])
+            for id in ops.get(IndexUpdates.REMOVE, []):
+                name_docs.append((id, None))
+            save_ids = ops.get(IndexUpdates.SAVE, [])
+            if not save_ids:
+                continue
+            model = _name_model[name]
+            query = session.query(model).filter(model.id.in_(save_ids))
+            saved = set()
+            for obj in query.options(*model_options.get(model, [])):
+                saved.add(obj.id)
+                if model is Note:
+                    doc = self._note_doc(obj)
                 else:
-                    # and modified docs
-                    log.debug('Check %s mtime' % indexed_id)
-                    try:
-                        indexed_time = fields['mtime']
-                        try:
-                            mtime = obj.mtime
-                        except AttributeError:
-                            # Notes don't have an mtime
-                            mtime = None
-                        if not mtime:
-                            mtime = obj.ctime
-                        if mtime > indexed_time:
-                            log.debug('%s has been modified' % indexed_id)
-                            to_index.add(indexed_id)
-                    except (KeyError, TypeError):
-                        to_index.add(indexed_id)
+                    doc = self._obj_doc(obj)
+                if doc is not None:
+                    name_docs.append((obj.id, doc))
+            # Saved and then deleted in the same transaction
+            for id in set(save_ids) - saved:
+                name_docs.append((id, None))
+        return docs
+
+    def _write_docs(self, docs):
+        """Write built documents with one writer per index."""
+        for name, name_docs in docs.items():
+            if not name_docs:
+                continue
+            try:
+                with self.writer(name) as ixw:
+                    if ixw is None:
+                        log.warn(u'Could not open index for {0}'.format(name))
+                        continue
+                    for id, doc in name_docs:
+                        if doc is None:
+                            ixw.delete_by_term(
+                                'id', _model_id_to_index_id(id))
+                        else:
+                            log.log(DETAIL, u'saving {0} {1!r}'.format(
+                                name, doc))
+                            ixw.update_document(**doc)
+            except Exception:
+                # The transaction is already committed.
+                log.error(u'Unable to update index {0}: {1}'.format(
+                    name, format_exc()))
+
+    def _enqueue(self, session, updates):
+        """Queue the updates for the indexer in the session's transaction."""
+        if not updates.ops:
+            return
+        session.execute(_IndexJob.__table__.insert(), [
+            {'index_name': name, 'doc_id': id, 'op': op}
+            for (name, id), op in updates.ops.items()])
+        mark_changed(session)
+
+    def apply_jobs(self, writers, batch_size=500):
+        """Apply a batch of queued index jobs.
+
+        writers - a dict of index name to BufferedWriter that is kept between
+            batches. The index lock is held as long as the writers are open.
+
+        The batch is committed to the index before its jobs are removed, so a
+        failure in between only repeats them. The caller commits the
+        database transaction.
+
+        Returns the number of jobs applied.
+
+        """
+        jobs = DBSession.query(_IndexJob).order_by(_IndexJob.id).\
+            limit(batch_size).all()
+        if not jobs:
+            return 0
+        updates = IndexUpdates()
+        for job in jobs:
+            updates.add(job.index_name, job.doc_id, job.op)
+        docs = self._build_docs(DBSession(), updates)
+        for name, name_docs in docs.items():
+            try:
+                ixw = writers[name]
+            except KeyError:
+                ixw = writers[name] = BufferedWriter(
+                    self.open_or_create_index(name), period=None,
+                    limit=batch_size)
+            for id, doc in name_docs:
+                if doc is None:
+                    ixw.delete_by_term('id', _model_id_to_index_id(id))
+                else:
+                    log.log(DETAIL, u'saving {0} {1!r}'.format(name, doc))
+                    ixw.update_document(**doc)
+            ixw.commit()
+        # Jobs with lower ids may still be uncommitted in other transactions,
+        # so only the fetched ones are removed.
+        DBSession.query(_IndexJob).filter(
+            _IndexJob.id.in_([job.id for job in jobs])).\
+            delete(synchronize_session=False)
+        mark_changed(DBSession())
+        log.info(u'Applied {0} index jobs'.format(len(jobs)))
+        return len(jobs)
+
+    def _clean_index(self, ixw, model, indexed_ids, to_index):
+        """Remove missing docs and collect the indexed and modified ids.
+
+        The current modification times of all instances come from one query.
+        They are compared to the stored mtime of each doc in one sweep of the
+        index.
+
+        """
+        if model is Note:
+            current = dict(DBSession.query(Note.id, Note.ts_c))
+        else:
+            current = dict(model.all_mtimes())
+
+        missing = []
+        ixs = ixw.searcher()
+        try:
+            for fields in ixs.all_stored_fields():
+                indexed_id = int(fields['id'])
+                indexed_ids.add(indexed_id)
+                try:
+                    mtime = current[indexed_id]
+                except KeyError:
+                    missing.append(fields['id'])
+                    continue
+                indexed_time = fields.get('mtime')
+                if indexed_time is None or \
+                        (mtime is not None and mtime > indexed_time):
+                    log.debug('%s has been modified' % indexed_id)
+                    to_index.add(indexed_id)
         except Exception as err:
             log.error(format_exc(err))
         finally:
             ixs.close()
 
-    def _rebuild_index(self, name, clear=False):
+        for indexed_id in missing:
+            log.debug('Remove missing id %s' % indexed_id)
+            ixw.delete_by_term('id', indexed_id)
+
+    def _ids_to_index(self, ixw, name, clear):
+        """Return the ids of the docs that need to be indexed, in order.
+
+        Unless clear, missing docs are removed from the index and only new and
+        modified docs are returned.
+
+        """
+        model = _name_model[name]
+        indexed_ids = set()
+        to_index = set()
+        if not clear:
+            log.info(u'Cleaning index and collecting indexed docs for '
+                     '{0}'.format(name))
+            self._clean_index(ixw, model, indexed_ids, to_index)
+            log.info('cleaned')
+        return [
+            id for id, in DBSession.query(model.id).order_by(model.id)
+            if id in to_index or id not in indexed_ids]
+
+    def _rebuild_index(self, name, clear=False,
+                       chunk_size=REBUILD_CHUNK_SIZE):
         with self.writer(name, clear=clear, buffered=True) as ixw:
             if ixw is None:
                 log.warn(u'Unable to index {0!r}'.format(name))
                 return
-            model = _name_model[name]
-
-            indexed_ids = set()
-            to_index = set()
-
-            if not clear:
-                log.info(u'Cleaning index and collecting indexed docs for '
-                         '{0}'.format(name))
-                self._clean_index(ixw, model, indexed_ids, to_index)
-                log.info('cleaned')
-                ixw.commit()
-
-            log.debug(repr(indexed_ids))
-            log.debug(repr(to_index))
-
-            objs = model.query().all()
+            ids = self._ids_to_index(ixw, name, clear)
+            ixw.commit()
 
             log.info('Indexing new and modified docs for %s' % name)
-            l = float(len(objs))
-            for i, obj in enumerate(objs):
-                # Index modified and new docs
-                oid = unicode(obj.id)
-                if oid in to_index or oid not in indexed_ids:
-                    log.debug('Indexing {0} {1}'.format(name, obj.id))
-                    if model is Note:
-                        self.save_note(obj, ixw)
-                    else:
-                        self.save_obj(obj, ixw)
-                if i % 50 == 0:
-                    log.info('%d/%d = %3.4f' % (i, l, i / l))
+            l = float(len(ids))
+            for i, chunk in enumerate(_chunks(ids, chunk_size)):
+                # Only one chunk of objs is in memory at a time.
+                _, docs = _build_chunk_docs(self, name, chunk)
+                for id, doc in docs:
+                    if doc is not None:
+                        ixw.update_document(**doc)
+                DBSession.expunge_all()
+                done = i * chunk_size + len(chunk)
+                log.info('%d/%d = %3.4f' % (done, l, done / l))
+
+    def _rebuild_parallel(self, names, clear=False, procs=None,
+                          chunk_size=REBUILD_CHUNK_SIZE):
+        """Rebuild the indexes with a process pool.
+
+        Chunks of docs for all the indexes are built concurrently by the pool
+        and written by a multiprocessing writer per index.
 
-    def rebuild_index(self, clear=False):
+        """
+        procs = procs or cpu_count()
+        pool = Pool(procs, _init_doc_worker, (self.index_dir, ))
+        writers = {}
+        try:
+            chunks = []
+            for name in names:
+                ix = self.open_or_create_index(name, clear)
+                ixw = ix.writer(procs=procs, multisegment=True)
+                writers[name] = (ix, ixw)
+                ids = self._ids_to_index(ixw, name, clear)
+                log.info(u'{0} docs to index for {1}'.format(len(ids), name))
+                chunks.extend((name, chunk) for chunk in
+                              _chunks(ids, chunk_size))
+            DBSession.remove()
+
+            for i, (name, docs) in enumerate(
+                    pool.imap_unordered(_build_chunk_docs_job, chunks)):
+                ixw = writers[name][1]
+                for id, doc in docs:
+                    if doc is not None:
+                        ixw.update_document(**doc)
+                log.info('%d/%d chunks' % (i + 1, len(chunks)))
+            pool.close()
+        except:
+            pool.terminate()
+            for ix, ixw in writers.values():
+                ixw.cancel()
+                ix.close()
+            raise
+        finally:
+            pool.join()
+        for name, (ix, ixw) in writers.items():
+            log.info(u'Committing {0}'.format(name))
+            ixw.commit()
+            ix.close()
+
+    def rebuild_index(self, clear=False, procs=1, names=None):
         """Indexes all Objs and Notes.
 
         If clear is set, the indices are cleared and optimizations are made to
@@ -589,15 +938,22 @@ class SearchIndex(object):
         If an index is known to be bad, it's best to clear it and rebuild the
         index using this function.
 
+        procs - the number of processes to build docs with. If more than one,
+            all the indexes are rebuilt at the same time. None uses all cores.
+        names - the indexes to rebuild (default: all)
+
         """
         log.info('Rebuilding search index')
         log.info('Clear index first? %r' % clear)
-        schemas = _schemas.keys()
+        schemas = list(names or _schemas.keys())
         if 'note' in schemas:
             schemas.remove('note')
             schemas.append('note')
-        for name in schemas:
-            self._rebuild_index(name, clear)
+        if procs == 1:
+            for name in schemas:
+                self._rebuild_index(name, clear)
+        else:
+            self._rebuild_parallel(schemas, clear, procs)
         log.info('Finished indexing')
 
     def _filter_seahunt_for_cruise_parser(self, query):
@@ -776,30 +1132,45 @@ class SearchIndex(object):
         return results
 
     def register_triggers(self):
+        """Queue index updates for changes to the model.
+
+        The updates are written once the transaction commits.
+
+        """
         # !!! Careful not to set these to trigger's eponymous functions or you
         # will infinite recurse.
-        triggers.saved_obj_actions.append(self.save_obj)
-        triggers.deleted_obj_actions.append(self.remove_obj)
-        triggers.saved_note_actions.append(self.save_note)
-        triggers.deleted_note_actions.append(self.remove_note)
+        triggers.saved_obj_actions.append(self.queue_save_obj)
+        triggers.deleted_obj_actions.append(self.queue_remove_obj)
+        triggers.saved_objs_actions.append(self.queue_save_objs)
+        triggers.deleted_objs_actions.append(self.queue_remove_objs)
+        triggers.saved_note_actions.append(self.queue_save_note)
+        triggers.deleted_note_actions.append(self.queue_remove_note)
 
     def unregister_triggers(self):
         if not triggers:
             return
         try:
-            triggers.saved_obj_actions.remove(self.save_obj)
+            triggers.saved_obj_actions.remove(self.queue_save_obj)
+        except ValueError:
+            pass
+        try:
+            triggers.deleted_obj_actions.remove(self.queue_remove_obj)
+        except ValueError:
+            pass
+        try:
+            triggers.saved_objs_actions.remove(self.queue_save_objs)
         except ValueError:
             pass
         try:
-            triggers.deleted_obj_actions.remove(self.remove_obj)
+            triggers.deleted_objs_actions.remove(self.queue_remove_objs)
         except ValueError:
             pass
         try:
-            triggers.saved_note_actions.remove(self.save_note)
+            triggers.saved_note_actions.remove(self.queue_save_note)
         except ValueError:
             pass
         try:
-            triggers.deleted_note_actions.remove(self.remove_note)
+            triggers.deleted_note_actions.remove(self.queue_remove_note)
         except ValueError:
             pass
 
@@ -807,6 +1178,43 @@ class SearchIndex(object):
         self.unregister_triggers()
 
 
+def _build_chunk_docs(search_index, name, ids):
+    """Build the docs for ids with the index's eager load options.
+
+    Returns (name, [(id, doc)]).
+
+    """
+    updates = IndexUpdates()
+    for id in ids:
+        updates.add(name, id, IndexUpdates.SAVE)
+    docs = search_index._build_docs(DBSession(), updates)
+    return (name, docs.get(name, []))
+
+
+# The SearchIndex of a rebuild worker process
+_worker_search_index = None
+
+
+def _init_doc_worker(index_dir):
+    global _worker_search_index
+    # Connections inherited from the parent must not be used or closed.
+    engine = DBSession().get_bind()
+    engine.pool = engine.pool.recreate()
+    DBSession.remove()
+    _worker_search_index = SearchIndex(index_dir)
+    # Workers only read.
+    _worker_search_index.unregister_triggers()
+
+
+def _build_chunk_docs_job(job):
+    name, ids = job
+    try:
+        return _build_chunk_docs(_worker_search_index, name, ids)
+    finally:
+        transaction.abort()
+        DBSession.remove()
+
+
 def compile_into_cruises(results):
     """Convert the results of a search() into a list of Cruises.
 
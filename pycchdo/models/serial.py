@@ -12,15 +12,17 @@ from decimal import Decimal
 from zipfile import ZipFile, BadZipfile
 
 from sqlalchemy import (
-    event, distinct,
+    event, distinct, cast, inspect,
     Table, Column, ForeignKey, 
     Integer, Unicode, String, Boolean, DateTime,
     )
 from sqlalchemy.exc import DataError, ProgrammingError
 from sqlalchemy.sql import (
-    func, and_, not_, or_,
+    func, and_, not_, or_, extract,
+    )
+from sqlalchemy.sql.expression import (
+    case, literal, update, union_all, select,
     )
-from sqlalchemy.sql.expression import case, literal, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property, Comparator
@@ -29,12 +31,13 @@ from sqlalchemy.orm import (
     joinedload, noload, with_polymorphic,
     )
 from sqlalchemy.orm.query import Query
+from sqlalchemy.orm.attributes import set_committed_value, get_history
 from sqlalchemy.orm.collections import (
     collection, InstrumentedSet, attribute_mapped_collection,
     )
 from sqlalchemy.schema import DropSchema, CreateSchema, Index
 
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
 import geojson
 
@@ -57,7 +60,9 @@ from pycchdo.models.file_types import (
     DataFileTypes,
     data_file_descriptions,
     )
-from pycchdo.util import drop_everything, is_valid_ip, timestamp_now
+from pycchdo.util import (
+    drop_everything, is_valid_ip, timestamp_now, LRUCache,
+    )
 from pycchdo.log import getLogger, INFO
 
 
@@ -304,6 +309,37 @@ def filter_query_change(query, state=None, replaced=False, query_modifier=None):
     return query
 
 
+def iter_keyset(query, ts_column, id_column, after=None, batch_size=100):
+    """Yield the results of a query newest first, a batch at a time.
+
+    The results are ordered by (ts_column, id_column) descending. Each batch
+    continues from the key of the last result instead of using an OFFSET so the
+    cost of a batch does not grow with how far along the results it is.
+
+    after - the id of a result to continue after
+
+    """
+    query = query.order_by(None).order_by(ts_column.desc(), id_column.desc())
+    after_ts = None
+    if after is not None:
+        after_ts = DBSession.query(ts_column).filter(
+            id_column == after).as_scalar()
+    while True:
+        batch = query
+        if after is not None:
+            batch = batch.filter(or_(
+                ts_column < after_ts,
+                and_(ts_column == after_ts, id_column < after)))
+        results = batch.limit(batch_size).all()
+        for result in results:
+            yield result
+        if len(results) < batch_size:
+            return
+        last = results[-1]
+        after_ts = getattr(last, ts_column.key)
+        after = getattr(last, id_column.key)
+
+
 def filter_changes_data(changes, data=True):
     """Filter Changes to those pertaining to attributes that store Files.
 
@@ -443,6 +479,91 @@ class Change(Base, MixinCreation, DBQueryable):
         else:
             return self._value_accepted
 
+    # Memo of deserialized values keyed by (id, raw value). Set per instance
+    # so that it lives only as long as the instance does in the session.
+    _deserialized = None
+
+    def _deserialize(self, raw):
+        """Deserialize a raw value of this Change, remembering the result.
+
+        Deserializing references to Objs and Files queries the database so
+        repeated accesses to the same value are served from the memo instead.
+        Lists and dicts are copied so callers may modify what they are given.
+
+        """
+        if self._deserialized is None:
+            self._deserialized = {}
+        key = (self.id, raw)
+        try:
+            value = self._deserialized[key]
+        except KeyError:
+            value = self._deserialized[key] = self.obj.deserialize(
+                self.attr, raw)
+        if isinstance(value, list):
+            return list(value)
+        elif isinstance(value, dict):
+            return dict(value)
+        return value
+
+    def _forget_deserialized(self):
+        self._deserialized = None
+
+    @classmethod
+    def resolve_values(cls, changes):
+        """Deserialize the Obj references held by many Changes at once.
+
+        The referenced ids are collected for each target model and each model is
+        loaded with one query. File attrs are references to FSFiles and are
+        loaded the same way. The results are remembered by each Change so that
+        accessing its values does not query again.
+
+        """
+        # (change, raw, serial, model) for each value that references Objs
+        pending = []
+        model_ids = {}
+        for change in changes:
+            if change.attr is None:
+                continue
+            try:
+                model = change.obj._attr_schemas()[change.attr].model
+            except KeyError:
+                continue
+            if model is None:
+                continue
+            for raw in set([change._value, change._value_accepted]):
+                if raw is None:
+                    continue
+                try:
+                    serial = loads(raw)
+                    if serial['type'] == 'obj':
+                        ids = [serial['val']]
+                    elif serial['type'] == 'objs':
+                        ids = serial['val']
+                    else:
+                        continue
+                except (ValueError, TypeError, KeyError):
+                    continue
+                pending.append((change, raw, serial, model))
+                model_ids.setdefault(model, set()).update(filter(None, ids))
+
+        loaded = {}
+        for model, ids in model_ids.items():
+            if not ids:
+                continue
+            for obj in model.query().filter(model.id.in_(ids)).all():
+                loaded[(model, obj.id)] = obj
+
+        for change, raw, serial, model in pending:
+            if serial['type'] == 'obj':
+                value = loaded.get((model, serial['val']))
+            else:
+                value = [loaded[(model, id)] for id in uniquify(serial['val'])
+                         if (model, id) in loaded]
+            if change._deserialized is None:
+                change._deserialized = {}
+            change._deserialized[(change.id, raw)] = value
+        return changes
+
     @property
     def value(self):
         """Deserialize the value from the database.
@@ -452,30 +573,32 @@ class Change(Base, MixinCreation, DBQueryable):
         suggested value deserialized.
 
         """
-        return self.obj.deserialize(self.attr, self._get_value())
+        return self._deserialize(self._get_value())
 
     @value.setter
     def value(self, val):
         """Serialize the value so it can be stored in the database.
 
         """
+        self._forget_deserialized()
         self._value = self.obj.serialize(self.attr, val)
 
     @property
     def value_original(self):
         """Deserialize the suggested value from the database."""
-        return self.obj.deserialize(self.attr, self._value)
+        return self._deserialize(self._value)
 
     @property
     def value_accepted(self):
         """Deserialize the accepted value from the database."""
-        return self.obj.deserialize(self.attr, self._value_accepted)
+        return self._deserialize(self._value_accepted)
 
     @value_accepted.setter
     def value_accepted(self, val):
         """Serialize the value so it can be stored in the database.
 
         """
+        self._forget_deserialized()
         self._value_accepted = self.obj.serialize(self.attr, val)
 
     def _set_value(self, val):
@@ -488,6 +611,7 @@ class Change(Base, MixinCreation, DBQueryable):
             self.value = val
         else:
             self.value_accepted = val
+        self.obj._update_current_value(self)
         self._set_cache(val)
 
     def _set_cache(self, val=None):
@@ -505,7 +629,7 @@ class Change(Base, MixinCreation, DBQueryable):
 
     def is_data(self):
         try:
-            return self.obj.attr_type(self.attr) == File
+            return self.obj._attr_schema(self.attr).is_file
         except ValueError:
             return False
 
@@ -540,13 +664,16 @@ class Change(Base, MixinCreation, DBQueryable):
 
         if self.is_obj:
             self.obj.accepted = True
-            self.obj.ts_j = timestamp_now()
+            self.obj.ts_j = self.ts_j
         else:
+            self.obj._change_accepted(self)
             self._set_cache()
+        self.obj._touch(self.ts_j)
 
     def acknowledge(self, person):
         self.p_ack = person
         self.ts_ack = timestamp_now()
+        self.obj._touch(self.ts_ack)
 
     def reject(self, person):
         self.p_j = person
@@ -555,6 +682,9 @@ class Change(Base, MixinCreation, DBQueryable):
 
         if self.is_obj:
             self.obj.accepted = False
+        else:
+            self.obj._change_rejected(self)
+        self.obj._touch(self.ts_j)
 
     @classmethod
     def only_if_accepted_is(cls, accepted=True):
@@ -833,20 +963,33 @@ class AllowableSerialMgr(AllowableMgr):
             obj = globals()[obj_type]
             cls.register_serializer_pair(
                 key, SerializerObj.serialize, SerializerObj.Deserializer(obj))
+            cls._allowed_attrs_dict()[key]['model'] = obj
         elif main_type == IDList:
             obj = globals()[obj_type]
             cls.register_serializer_pair(
                 key, SerializerObjs.serialize, SerializerObjs.Deserializer(obj))
+            cls._allowed_attrs_dict()[key]['model'] = obj
         elif main_type == TextList:
             cls.register_serializer_pair(key, Serializer)
         elif main_type == DateTime:
             cls.register_serializer_pair(key, SerializerDateTime)
         elif main_type == File:
             cls.register_serializer_pair(key, SerializerFSFile)
+            cls._allowed_attrs_dict()[key]['model'] = FSFile
         elif main_type == LineString:
             cls.register_serializer_pair(key, SerializerTrack)
         else:
             cls.register_serializer_pair(key, Serializer)
+        cls._invalidate_attr_schemas()
+
+    @classmethod
+    def _compile_attr_schema(cls, key, attrdef):
+        schema = super(AllowableSerialMgr, cls)._compile_attr_schema(
+            key, attrdef)
+        status_ending = getattr(cls, 'DATA_STATUS_ENDING', None)
+        return schema._replace(
+            is_file=schema.type == File,
+            is_status=bool(status_ending) and key.endswith(status_ending))
 
     @classmethod
     def register_serializer_pair(cls, attr, serializer, deserializer=None):
@@ -870,33 +1013,43 @@ class AllowableSerialMgr(AllowableMgr):
                 cls, attr, deserializer))
         except KeyError:
             attrdef['deserializer'] = deserializer
+        cls._invalidate_attr_schemas()
 
-    def serialize(self, attr, value):
+    @classmethod
+    def _serialize(cls, attr, value):
         """Serialize the value from a python object to a string."""
         try:
-            attrdef = self._allowed_attrs_dict()[attr]
+            schema = cls._attr_schemas()[attr]
         except KeyError:
             raise ValueError(
                 u'{0} cannot be stored as {1!r}'.format(value, attr))
         try:
-            return attrdef['serializer'](value)
+            if schema.serializer is None:
+                raise KeyError(attr)
+            return schema.serializer(value)
         except KeyError:
             if not isinstance(value, basestring):
                 if attr is not None or value is not None:
                     raise ValueError(
                         u'No serializer for {0}.{1}: {2!r}'.format(
-                        self, attr, value))
+                        cls, attr, value))
             return value
         except Exception, err:
             log.error(u'Unable to serialize {0}.{1}: {2!r}: {3!r}'.format(
-                self, attr, value, err))
+                cls, attr, value, err))
             raise
 
+    def serialize(self, attr, value):
+        """Serialize the value from a python object to a string."""
+        return self._serialize(attr, value)
+
     def deserialize(self, attr, value):
         """Deserialize the value from a string to a python object."""
         try:
-            attrdef = self._allowed_attrs_dict()[attr]
-            return attrdef['deserializer'](value)
+            deserializer = self._attr_schemas()[attr].deserializer
+            if deserializer is None:
+                return value
+            return deserializer(value)
         except KeyError:
             return value
         except Exception, err:
@@ -936,10 +1089,9 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
     in the database to allow for quicker queries against them. The suggested and
     rejected Changes should still be accessible through the interfaces provided.
 
-    get_all_by_attrs() is a type of query that was omitted for the sake of using
-    the cache. This may end up being something we want in the future but it is
-    not needed at the moment. Querying against JSON would help immensely in the
-    implementation.
+    The current accepted Change and its serialized value for each attr are kept
+    in obj_current_attrs. Reading an attr is a lookup there and
+    get_all_by_attrs() filters on the serialized values.
 
     All Obj notes are stored against the Obj's Change.
 
@@ -952,8 +1104,16 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
     accepted = Column(Boolean, default=False)
     ts_j = Column(DateTime)
 
+    # Denormalized last modified time. Kept current by Change judgments and
+    # acknowledgements so that it can be read without querying Changes.
+    _mtime = Column('mtime', DateTime, default=func.now())
+
     import_id = Column(Unicode)
 
+    _current_attrs = relationship(
+        '_ObjCurrentAttr', collection_class=attribute_mapped_collection('attr'),
+        cascade='all, delete-orphan', passive_deletes=True)
+
     __mapper_args__ = {
         'polymorphic_on': obj_type,
         'polymorphic_identity': 'obj',
@@ -971,22 +1131,75 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
     def ctime(self):
         return self.change.ts_c
 
-    @property
+    @hybrid_property
     def mtime(self):
         """Last modified time.
-        This is either the object creation time or the latest attribute judgment
-        time.
+
+        This is either the object creation time or the latest time one of its
+        Changes was judged or acknowledged.
+
+        The value is stored on the Obj. Objs that predate the column and have
+        not been backfilled fall back to calculating it from their Changes.
 
         """
-        creation_time = self.ctime
-        accepted = self._order_changes(self.changes_query('accepted')).first()
-        if not accepted:
-            return creation_time
-        last_attr_ctime = accepted.ts_j
-        try:
-            return max(creation_time, last_attr_ctime)
-        except TypeError:
-            return creation_time
+        if self._mtime is not None:
+            return self._mtime
+        mtimes = _query_mtimes()
+        return DBSession.query(mtimes.c.mtime).filter(
+            mtimes.c.obj_id == self.id).scalar()
+
+    @mtime.expression
+    def mtime(cls):
+        return cls._mtime
+
+    def _touch(self, time):
+        """Bump the last modified time if time is more recent."""
+        if time is None:
+            return
+        if self._mtime is None or self._mtime < time:
+            self._mtime = time
+
+    @classmethod
+    def backfill_mtime(cls):
+        """Recalculate the stored last modified time for all Objs.
+
+        This is done in one statement from the Changes. It needs to be run once
+        for databases that predate the column and after imports that alter
+        judgment times directly.
+
+        """
+        mtimes = _query_mtimes()
+        objs = Obj.__table__
+        DBSession.execute(update(objs).\
+            values(mtime=mtimes.c.mtime).\
+            where(objs.c.id == mtimes.c.obj_id))
+        mark_changed(DBSession())
+
+    @classmethod
+    def all_mtimes(cls):
+        """Return a query of (id, last modified time) for all instances.
+
+        Instances without a stored time fall back to calculating it from their
+        Changes in the same statement.
+
+        """
+        query = DBSession.query(cls.id, cls._mtime)
+        unset = DBSession.query(cls.id).filter(cls._mtime == None).exists()
+        if not DBSession.query(unset).scalar():
+            return query
+        mtimes = _query_mtimes()
+        return DBSession.query(
+            cls.id, func.coalesce(cls._mtime, mtimes.c.mtime)).\
+            outerjoin(mtimes, mtimes.c.obj_id == cls.id)
+
+    @classmethod
+    def recently_modified(cls, limit=None):
+        """Return accepted instances ordered by most recently modified."""
+        query = cls.query().filter(cls.accepted == True).\
+            filter(cls.mtime != None).order_by(cls.mtime.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
     @hybrid_property
     def change(self):
@@ -1020,6 +1233,44 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
         else:
             return filter_changes_data(changes, data)
 
+    def iter_changes(self, state=None, data=None, after=None, replaced=False,
+                     batch_size=100):
+        """Iterate over the Obj's Changes, newest suggestion first.
+
+        The Changes are fetched from the database a batch at a time.
+
+        data - if True, only Changes to File attrs. If False, only Changes to
+            other attrs.
+        after - the id of a Change to continue after
+
+        """
+        query = self.changes_query(state, replaced)
+        if data is not None:
+            file_keys = [
+                key for key, schema in self._attr_schemas().items()
+                if schema.is_file]
+            if data:
+                query = query.filter(Change.attr.in_(file_keys))
+            else:
+                query = query.filter(not_(Change.attr.in_(file_keys)))
+        return iter_keyset(query, Change.ts_c, Change.id, after, batch_size)
+
+    def iter_notes(self, discussion=None, after=None, batch_size=100):
+        """Iterate over the Obj's notes, newest first.
+
+        discussion - if True, only discussion notes. If False, only public
+            notes.
+        after - the id of a Note to continue after
+
+        """
+        query = self.change._notes
+        if discussion is not None:
+            if discussion:
+                query = query.filter(Note.discussion)
+            else:
+                query = query.filter(not_(Note.discussion))
+        return iter_keyset(query, Note.ts_c, Note.id, after, batch_size)
+
     @classmethod
     def _order_changes(cls, query):
         """Order a query for Changes by non-ascending time of judgment."""
@@ -1043,11 +1294,15 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
         Raises: KeyError if no changes.
 
         """
-        change = self._filter_changes_attr(
-            self.changes_query('accepted'), attr).first()
-        if change is None:
-            raise KeyError(attr)
-        return change
+        try:
+            change = self._prefetched_attrs[attr]
+        except (TypeError, KeyError):
+            pass
+        else:
+            if change is None:
+                raise KeyError(attr)
+            return change
+        return self._current_attrs[attr].change
 
     def get_attr_or(self, attr, default=None):
         """Return the most recent accepted Change for key or default."""
@@ -1062,15 +1317,137 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
 
     def get_attrs_or(self, attrs, default=None):
         """Return the most recent accepted Change for the keys or default."""
-        changes = self._order_changes(self.changes_query('accepted').\
-            filter(Change.attr.in_(attrs))).all()
-        first_occurence = {}
+        prefetched = self._prefetched_attrs
+        if prefetched is not None and all(attr in prefetched for attr in attrs):
+            return filter(None, [prefetched[attr] for attr in attrs])
+        current = self._current_attrs
+        return [current[attr].change for attr in attrs if attr in current]
+
+    def _update_current_attr(self, change):
+        """Make the accepted change the current one for its attr."""
+        try:
+            current = self._current_attrs[change.attr]
+        except KeyError:
+            self._current_attrs[change.attr] = _ObjCurrentAttr(change)
+        else:
+            current.change = change
+            current.value = change._get_value()
+
+    def _replace_current_attr(self, change):
+        """Replace change as the current one for its attr if it was.
+
+        The most recent remaining accepted Change takes its place.
+
+        """
+        try:
+            current = self._current_attrs[change.attr]
+        except KeyError:
+            return
+        if current.change is not change:
+            return
+        latest = self._filter_changes_attr(
+            self.changes_query('accepted'), change.attr).\
+            filter(Change.id != change.id).first()
+        if latest is None:
+            del self._current_attrs[change.attr]
+        else:
+            self._update_current_attr(latest)
+
+    def _update_current_value(self, change):
+        """Update the current value for change's attr if change is current."""
+        try:
+            current = self._current_attrs[change.attr]
+        except KeyError:
+            return
+        if current.change is change:
+            current.value = change._get_value()
+
+    @classmethod
+    def rebuild_current_attrs(cls, obj_ids=None):
+        """Recalculate the current attrs for Objs from their Changes.
+
+        This needs to be run once for databases that predate obj_current_attrs
+        and after imports that alter Changes directly.
+
+        obj_ids - if given, only rebuild for these Objs. Otherwise, all Objs.
+
+        """
+        latest = filter_query_change(DBSession.query(
+            Change.obj_id, Change.attr, Change.id,
+            func.coalesce(Change._value_accepted, Change._value)), 'accepted').\
+            distinct(Change.obj_id, Change.attr).\
+            order_by(Change.obj_id, Change.attr, Change.ts_j.desc())
+        table = _ObjCurrentAttr.__table__
+        delete = table.delete()
+        if obj_ids is not None:
+            latest = latest.filter(Change.obj_id.in_(obj_ids))
+            delete = delete.where(table.c.obj_id.in_(obj_ids))
+        DBSession.execute(delete)
+        DBSession.execute(table.insert().from_select(
+            ['obj_id', 'attr', 'change_id', 'value'], latest.statement))
+        mark_changed(DBSession())
+
+    @classmethod
+    def query_by_attrs(cls, **attrs):
+        """Return a query for the instances whose current attrs have values."""
+        query = cls.query()
+        for attr, value in attrs.items():
+            current = aliased(_ObjCurrentAttr)
+            query = query.join(current, and_(
+                current.obj_id == cls.id, current.attr == attr,
+                current.value == cls._serialize(attr, value)))
+        return query
+
+    @classmethod
+    def get_all_by_attrs(cls, **attrs):
+        """Return the instances whose current attrs have the values."""
+        return cls.query_by_attrs(**attrs).all()
+
+    # Map from attr to the most recent accepted Change (or None) filled by
+    # prefetch_attrs. Set per instance.
+    _prefetched_attrs = None
+
+    @classmethod
+    def prefetch_attrs(cls, objs, attrs):
+        """Load the current Changes for attrs of many Objs at once.
+
+        The Changes are remembered on each Obj so that get_attr, get_attrs_or
+        and get do not query for these attrs again.
+
+        """
+        objs = filter(None, objs)
+        attrs = list(attrs)
+        if not objs or not attrs:
+            return
+        id_objs = dict((obj.id, obj) for obj in objs)
+
+        changes = Change.query().join(
+            _ObjCurrentAttr, _ObjCurrentAttr.change_id == Change.id).\
+            filter(_ObjCurrentAttr.obj_id.in_(id_objs.keys())).\
+            filter(_ObjCurrentAttr.attr.in_(attrs)).all()
+
+        for obj in objs:
+            if obj._prefetched_attrs is None:
+                obj._prefetched_attrs = {}
+            for attr in attrs:
+                obj._prefetched_attrs[attr] = None
         for change in changes:
-            try:
-                first_occurence[change.attr]
-            except KeyError:
-                first_occurence[change.attr] = change
-        return filter(None, [first_occurence.get(attr, None) for attr in attrs])
+            id_objs[change.obj_id]._prefetched_attrs[change.attr] = change
+
+    def _forget_prefetched(self, attr):
+        """Drop a prefetched attr so that it will be loaded again."""
+        if self._prefetched_attrs is not None:
+            self._prefetched_attrs.pop(attr, None)
+
+    def _change_accepted(self, change):
+        """Update what is kept about the Obj's attrs for an accepted Change."""
+        self._forget_prefetched(change.attr)
+        self._update_current_attr(change)
+
+    def _change_rejected(self, change):
+        """Update what is kept about the Obj's attrs for a rejected Change."""
+        self._forget_prefetched(change.attr)
+        self._replace_current_attr(change)
 
     def sugg(self, person, attr, value):
         """Suggest that an attribute's value should be."""
@@ -1185,6 +1562,29 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
         """
         DBSession.delete(self)
 
+    @classmethod
+    def _merge_columns(cls):
+        """Columns other than attr caches that refer to instances.
+
+        Returns a list of (column, owner) where owner, if not None, is the
+        column of the Obj ids that need reindexing when the column is
+        reassigned.
+
+        """
+        return []
+
+    def merge(self, signer, *mergees, **kwargs):
+        """Merge other instances into this one and remove them.
+
+        References to the mergees are reassigned to this instance.
+
+        dry_run - if True, only count the references
+
+        Returns a dict of reference kind to the number of references.
+
+        """
+        return ObjMerger(self, mergees).run(kwargs.get('dry_run', False))
+
     @classmethod
     def propose(cls, person):
         """Propose a Change to add a new instance of this class."""
@@ -1230,6 +1630,50 @@ class Obj(Base, DBQueryable, Creatable, AllowableSerialMgr):
         return u'{cls}()'.format(cls=type(self))
 
 
+Index('idx_objs_mtime', Obj.__table__.c.mtime)
+
+
+class _ObjCurrentAttr(Base):
+    """The current accepted Change for an Obj's attr and its serialized value.
+
+    """
+    __tablename__ = 'obj_current_attrs'
+
+    obj_id = Column(
+        Integer, ForeignKey('objs.id', ondelete='CASCADE'), primary_key=True)
+    attr = Column(Unicode, primary_key=True)
+    change_id = Column(
+        Integer, ForeignKey('changes.id', ondelete='CASCADE'), nullable=False)
+    change = relationship(Change, lazy='joined')
+    value = Column(Unicode)
+
+    def __init__(self, change):
+        self.attr = change.attr
+        self.change = change
+        self.value = change._get_value()
+
+    def __repr__(self):
+        return u'<ObjCurrentAttr({0}, {1}, {2})>'.format(
+            self.obj_id, self.attr, self.change_id)
+
+
+def _query_mtimes():
+    """Return a subquery of the last modified time for each Obj id.
+
+    The last modified time is the latest of the creation time and the judgment
+    and acknowledgement times of the Obj's Changes.
+
+    """
+    ctime = case([(and_(Change.attr == None, Change._value == None),
+                   Change.ts_c)])
+    return DBSession.query(
+        Change.obj_id.label('obj_id'),
+        func.greatest(
+            func.max(ctime), func.max(Change.ts_j), func.max(Change.ts_ack)
+        ).label('mtime')).\
+        group_by(Change.obj_id).subquery()
+
+
 once_at_end.register(lambda:
     Obj.allow_attr('import_id', String, 'Import ID'))
 
@@ -1410,6 +1854,233 @@ class FSFile(Base, DBQueryable, AdaptedFile):
         return unicode(self)
 
 
+class ObjMerger(object):
+    """Merge Objs into a survivor using set-based updates.
+
+    References to the mergees are found in
+
+    * the columns given by the survivor's _merge_columns(),
+    * the serialized values of Changes to attrs whose model is the survivor's
+      class and
+    * the columns and association tables that cache those attrs.
+
+    Each kind of reference is reassigned with UPDATEs on the matching rows in
+    the current transaction instead of being loaded and set one by one. The
+    Objs whose values changed are then reindexed in a single batch.
+
+    """
+    def __init__(self, survivor, mergees):
+        self.survivor = survivor
+        self.mergees = [m for m in mergees if m.id != survivor.id]
+        self.mergee_ids = [m.id for m in self.mergees]
+
+    @classmethod
+    def _obj_classes(cls, base=None):
+        if base is None:
+            base = Obj
+        yield base
+        for sub in base.__subclasses__():
+            for subsub in cls._obj_classes(sub):
+                yield subsub
+
+    def _referencing_attrs(self):
+        """Return the attrs that refer to the survivor's class.
+
+        Returns a dict of attr to the set of relationships that cache the attr.
+
+        """
+        attrs = {}
+        for objcls in self._obj_classes():
+            mapper = inspect(objcls)
+            for attr, schema in objcls._attr_schemas().items():
+                if not schema.model or not isinstance(
+                        self.survivor, schema.model):
+                    continue
+                props = attrs.setdefault(attr, set())
+                if attr in mapper.relationships:
+                    props.add(mapper.relationships[attr])
+        return attrs
+
+    def _replace_ids(self, ids):
+        """Delete mergee ids from ids, replacing the first with the survivor."""
+        sid = self.survivor.id
+        replaced = sid in ids
+        new_ids = []
+        for iid in ids:
+            if iid in self.mergee_ids:
+                if not replaced:
+                    new_ids.append(sid)
+                    replaced = True
+            else:
+                new_ids.append(iid)
+        return new_ids
+
+    def _rewrite_value(self, raw):
+        """Return raw serialized with the mergees replaced or None if the value
+        does not refer to any mergee.
+
+        """
+        try:
+            serial = loads(raw)
+            stype = serial['type']
+            val = serial['val']
+        except (TypeError, ValueError, KeyError):
+            return None
+        if stype == 'obj' and val in self.mergee_ids:
+            return SerializerObj.serialize(self.survivor)
+        elif (stype == 'objs' and isinstance(val, list) and
+              any(iid in self.mergee_ids for iid in val)):
+            return dumps({'type': 'objs', 'obj_type': serial['obj_type'],
+                          'val': self._replace_ids(val)})
+        return None
+
+    def _value_rewrites(self, attrs):
+        """Find the Changes whose values refer to the mergees.
+
+        Returns a dict of (column name, new value) to Change ids, the (Change
+        id, column name) pairs whose value is the current value of the Change
+        and the ids of their Objs.
+
+        """
+        rewrites = {}
+        current = set()
+        obj_ids = set()
+        if not attrs:
+            return rewrites, current, obj_ids
+
+        # Narrow down the rows on the server, the values are checked properly
+        # below.
+        likes = []
+        for mid in self.mergee_ids:
+            pattern = u'%{0}%'.format(mid)
+            likes.append(Change._value.like(pattern))
+            likes.append(Change._value_accepted.like(pattern))
+        query = DBSession.query(
+            Change.id, Change.obj_id, Change._value, Change._value_accepted).\
+            filter(Change.attr.in_(list(attrs))).filter(or_(*likes))
+        for cid, obj_id, value, value_accepted in query:
+            for column, raw in (('value', value),
+                                ('value_accepted', value_accepted)):
+                if raw is None:
+                    continue
+                new = self._rewrite_value(raw)
+                if new is None:
+                    continue
+                rewrites.setdefault((column, new), []).append(cid)
+                obj_ids.add(obj_id)
+                if column == 'value_accepted' or value_accepted is None:
+                    current.add((cid, column))
+        return rewrites, current, obj_ids
+
+    def _cache_updates(self, props):
+        """Return the count and reassignment for each cache of the attrs."""
+        sid = self.survivor.id
+        mergee_ids = self.mergee_ids
+        updates = []
+        seen = set()
+        for prop in props:
+            if prop.secondary is not None:
+                table = prop.secondary
+                if table in seen:
+                    continue
+                seen.add(table)
+                owner = prop.synchronize_pairs[0][1]
+                target = prop.secondary_synchronize_pairs[0][1]
+                has_survivor = select([owner]).where(target == sid)
+                # Owners that refer to several mergees, or to a mergee and the
+                # survivor, only get a single reference to the survivor.
+                stmts = [
+                    table.insert().from_select(
+                        [owner.name, target.name],
+                        select([owner, literal(sid)]).distinct().
+                        where(target.in_(mergee_ids)).
+                        where(not_(owner.in_(has_survivor)))),
+                    table.delete().where(target.in_(mergee_ids)),
+                    ]
+                count = select([func.count()]).select_from(table).\
+                    where(target.in_(mergee_ids))
+            else:
+                column = list(prop.local_columns)[0]
+                if column in seen:
+                    continue
+                seen.add(column)
+                stmts = [column.table.update().where(
+                    column.in_(mergee_ids)).values({column.name: sid})]
+                count = select([func.count()]).select_from(column.table).\
+                    where(column.in_(mergee_ids))
+            updates.append((unicode(prop), count, stmts))
+        return updates
+
+    def run(self, dry_run=False):
+        """Reassign all references to the mergees and remove them.
+
+        dry_run - if True, only count the references
+
+        Returns a dict of reference kind to the number of references.
+
+        """
+        counts = {}
+        if not self.mergees:
+            return counts
+        DBSession.flush()
+
+        sid = self.survivor.id
+        mergee_ids = self.mergee_ids
+        reindex_ids = set([sid])
+
+        for column, owner in self.survivor._merge_columns():
+            query = DBSession.query(column.class_).filter(
+                column.in_(mergee_ids))
+            key = unicode(column)
+            counts[key] = query.count()
+            if dry_run or not counts[key]:
+                continue
+            if owner is not None:
+                reindex_ids |= set(
+                    x for x, in query.with_entities(owner).distinct() if x)
+            query.update({column: sid}, synchronize_session=False)
+
+        attrs = self._referencing_attrs()
+        rewrites, current, obj_ids = self._value_rewrites(attrs)
+        counts['changes'] = len(set(cid for ids in rewrites.values()
+                                    for cid in ids))
+        reindex_ids |= obj_ids
+
+        props = set()
+        for attr_props in attrs.values():
+            props |= attr_props
+        for key, count, stmts in self._cache_updates(props):
+            counts[key] = DBSession.execute(count).scalar()
+            if dry_run or not counts[key]:
+                continue
+            for stmt in stmts:
+                DBSession.execute(stmt)
+
+        if dry_run:
+            return counts
+
+        change_table = Change.__table__
+        current_table = _ObjCurrentAttr.__table__
+        for (column, new), cids in rewrites.items():
+            DBSession.execute(change_table.update().where(
+                change_table.c.id.in_(cids)).values({column: new}))
+            cids = [cid for cid in cids if (cid, column) in current]
+            if cids:
+                DBSession.execute(current_table.update().where(
+                    current_table.c.change_id.in_(cids)).values(value=new))
+        mark_changed(DBSession())
+
+        # Everything loaded may be referring to the mergees.
+        DBSession.expire_all()
+        for mergee in self.mergees:
+            mergee.remove()
+        DBSession.flush()
+
+        triggers.saved_objs(Obj.get_all_by_ids(*reindex_ids))
+        triggers.deleted_objs(self.mergees)
+        return counts
+
+
 class Country(Obj):
     """Store references to countries based on ISO 3166-1 alpha 2 and 3."""
     __tablename__ = 'countries'
@@ -1446,15 +2117,6 @@ class Country(Obj):
             return two
         return self.name
 
-    def merge(self, signer, *mergees):
-        changes = Change.query().filter(Change.attr == 'country').all()
-        for change in changes:
-            if change.value in mergees:
-                change._set_value(self)
-
-        for mergee in mergees:
-            mergee.remove()
-
     def to_dict(self):
         """Returns a dict representation of the Country."""
         rep = super(Country, self).to_dict()
@@ -1490,40 +2152,12 @@ class Institution(Obj):
         'polymorphic_identity': 'institution',
     }
 
-    def merge(self, signer, *mergees):
-        mergee_ids = [m.id for m in mergees]
-
-        participants = Participant.query().\
-            filter(Participant.institution_id.in_(mergee_ids)).all()
-        for p in participants:
-            p.institution = self
-
-        pis = ParameterInformation.query().\
-            filter(ParameterInformation.inst_id.in_(mergee_ids)).all()
-        for pi in pis:
-            pi.inst = self
-
-        changes = Change.query().filter(Change.attr == 'institutions').all()
-        for change in changes:
-            insts = change.value
-            new_insts = []
-            replaced = False
-            for inst in insts:
-                if inst not in mergees:
-                    new_insts.append(inst)
-                else:
-                    if not replaced:
-                        new_insts.append(self)
-                        replaced = True
-            change._set_value(new_insts)
-
-        changes = Change.query().filter(Change.attr == 'institution').all()
-        for change in changes:
-            if change.value in mergees:
-                change._set_value(self)
-
-        for mergee in mergees:
-            mergee.remove()
+    @classmethod
+    def _merge_columns(cls):
+        return [
+            (Participant.institution_id, Participant.cruise_id),
+            (ParameterInformation.inst_id, None),
+            ]
 
     def to_dict(self):
         """Returns a dict representation of the Institution."""
@@ -1567,15 +2201,6 @@ class Ship(Obj):
         'polymorphic_identity': 'ship',
     }
 
-    def merge(self, signer, *mergees):
-        changes = Change.query().filter(Change.attr == 'ship').all()
-        for change in changes:
-            if change.value in mergees:
-                change._set_value(self)
-
-        for mergee in mergees:
-            mergee.remove()
-
     def to_dict(self):
         """Returns a dict representation of the Ship."""
         rep = super(Ship, self).to_dict()
@@ -1696,55 +2321,48 @@ class Person(Obj):
             return False
         return False
 
-    def merge(self, signer, *mergees):
-        mergee_ids = [m.id for m in mergees]
-        cs = Change.query().filter(Change.p_id_c.in_(mergee_ids)).all()
-        for c in cs:
-            c.p_c = self
-        cs = Change.query().filter(Change.p_id_ack.in_(mergee_ids)).all()
-        for c in cs:
-            c.p_ack = self
-        cs = Change.query().filter(Change.p_id_j.in_(mergee_ids)).all()
-        for c in cs:
-            c.p_j = self
-        changes = Change.query().filter(Change.obj_id.in_(mergee_ids)).all()
-        for change in changes:
-            change.obj = self
-
-        notes = Note.query().filter(Note.p_id_c.in_(mergee_ids)).all()
-        for note in notes:
-            note.p_c = self
-
-        pis = ParameterInformation.query().\
-            filter(ParameterInformation.pi_id.in_(mergee_ids)).all()
-        for pi in pis:
-            pi.pi = self
-
-        perms = OrderedSet(self.permissions)
-        for mergee in mergees:
-            perms |= OrderedSet(mergee.permissions)
-        self.permissions = list(perms)
-
-        participants = Participant.query().\
-            filter(Participant.person_id.in_(mergee_ids)).all()
-        cruises = []
-        for p in participants:
-            pps = list(p.cruise.participants)
-            try:
-                idx = pps.index(Participant(p.role, self))
-                pp = pps[idx]
-                if pp.institution and p.institution:
-                    log.warn(u'Cannot merge role-persons with different '
-                             'institution {0} {1}'.format(
-                        pp.institution, p.institution))
-                else:
-                    if p.institution:
-                        pp.institution = p.institution
-            except ValueError:
-                p.person = self
-
-        for mergee in mergees:
-            mergee.remove()
+    @classmethod
+    def _merge_columns(cls):
+        return [
+            (Change.p_id_c, None),
+            (Change.p_id_ack, None),
+            (Change.p_id_j, None),
+            (Change.obj_id, None),
+            (Note.p_id_c, None),
+            (ParameterInformation.pi_id, None),
+            (Participant.person_id, Participant.cruise_id),
+            ]
+
+    def merge(self, signer, *mergees, **kwargs):
+        dry_run = kwargs.get('dry_run', False)
+        mergee_ids = [m.id for m in mergees if m.id != self.id]
+        if not dry_run and mergee_ids:
+            perms = OrderedSet(self.permissions)
+            for mergee in mergees:
+                perms |= OrderedSet(mergee.permissions)
+            self.permissions = list(perms)
+            DBSession.flush()
+
+            # Role-persons already on a cruise pick up the mergee's institution
+            # if they have none.
+            part = Participant.__table__
+            other = part.alias()
+            DBSession.execute(part.update().
+                where(part.c.person_id == self.id).
+                where(part.c.institution_id == None).
+                values(institution_id=select([other.c.institution_id]).
+                    where(other.c.person_id.in_(mergee_ids)).
+                    where(other.c.cruise_id == part.c.cruise_id).
+                    where(other.c.role == part.c.role).
+                    where(other.c.institution_id != None).
+                    limit(1).as_scalar()))
+
+        counts = super(Person, self).merge(signer, *mergees, **kwargs)
+        if not dry_run and mergee_ids:
+            # The mergees' Changes now belong to this Person.
+            Obj.rebuild_current_attrs([self.id])
+            DBSession.expire(self)
+        return counts
 
     @classmethod
     def propose(cls, sponsor=None):
@@ -1904,36 +2522,18 @@ class Collection(MultiName, Obj):
         except IndexError:
             return None
 
-    def _replace_occurrences_with(self, lll, mmm, val):
-        """Delete elements in mmm from lll, replacing the first with val."""
-        nnn = []
-        replaced = False
-        if val in lll:
-            replaced = True
-        for ll in lll:
-            if ll in mmm:
-                if not replaced:
-                    nnn.append(val)
-                    replaced = True
-            else:
-                nnn.append(ll)
-        return nnn
-
-    def merge(self, signer, *mergees):
+    def merge(self, signer, *mergees, **kwargs):
         """Merge other Collections into this one."""
         log.debug(u'Merging into {0} <- {1}'.format(self, mergees))
-        mergee_set = OrderedSet(mergees)
+        if kwargs.get('dry_run', False):
+            return super(Collection, self).merge(signer, *mergees, **kwargs)
         names = OrderedSet(self.names)
         types = OrderedSet(filter(None, [self.type]))
         oceans = OrderedSet(self.oceans)
-        cruises = OrderedSet()
-        mergee_ids = OrderedSet()
         for mergee in mergees:
             names |= OrderedSet(mergee.names)
             if mergee.type:
                 types.add(mergee.type)
-            mergee_ids.add(mergee.id)
-            cruises |= OrderedSet(mergee.cruises)
             oceans |= OrderedSet(mergee.oceans)
         names = list(names)
 
@@ -1953,16 +2553,7 @@ class Collection(MultiName, Obj):
         if oceans:
             self.set(signer, 'oceans', list(oceans))
 
-        # Cruises referencing mergees via collections need to be redirected to
-        # this collection instead.
-        for cruise in cruises:
-            colls = self._replace_occurrences_with(
-                cruise.collections, mergee_set, self)
-            change = cruise.get_attr('collections')
-            change._set_value(colls)
-
-        for mergee in mergees:
-            mergee.remove()
+        return super(Collection, self).merge(signer, *mergees, **kwargs)
 
     def to_dict(self):
         """Returns a dict representation of the Collection."""
@@ -2679,6 +3270,125 @@ class CruiseDateFilter(object):
                self.d2y(cruise.date_end) <= self.time_range[1]
 
 
+class _CruiseDataUpdate(Base):
+    """The most recently accepted data file Change for a cruise.
+
+    Feeds the recent dataset updates.
+
+    """
+    __tablename__ = 'cruise_data_updates'
+
+    cruise_id = Column(
+        Integer, ForeignKey('cruises.id', ondelete='CASCADE'),
+        primary_key=True)
+    change_id = Column(
+        Integer, ForeignKey('changes.id', ondelete='CASCADE'), nullable=False)
+    change = relationship(Change)
+    ts_j = Column(DateTime, index=True)
+
+    def __init__(self, change):
+        self.change = change
+        self.ts_j = change.ts_j
+
+
+class _CruiseIdentifier(Base):
+    """Maps every form of Cruise identifier to the Cruise id.
+
+    The forms are, in order of precedence, the id itself, the ExpoCode and the
+    aliases of accepted Cruises.
+
+    """
+    __tablename__ = 'cruise_identifiers'
+
+    KINDS = ['id', 'expocode', 'alias']
+
+    id = Column(Integer, primary_key=True)
+    identifier = Column(Unicode, nullable=False, index=True)
+    kind = Column(String(8), nullable=False)
+    cruise_id = Column(
+        Integer, ForeignKey('cruises.id', ondelete='CASCADE'), nullable=False,
+        index=True)
+
+    @classmethod
+    def rows_for(cls, cruise):
+        rows = [dict(identifier=unicode(cruise.id), kind='id')]
+        if cruise.expocode:
+            rows.append(dict(identifier=unicode(cruise.expocode),
+                             kind='expocode'))
+        if cruise.accepted:
+            for alias in uniquify(cruise.aliases or []):
+                if alias:
+                    rows.append(dict(identifier=unicode(alias), kind='alias'))
+        for row in rows:
+            row['cruise_id'] = cruise.id
+        return rows
+
+
+def _dedup_consecutive(coords):
+    """Remove consecutive duplicate points from a list of coordinates."""
+    deduped = []
+    for coord in coords:
+        coord = list(coord[:2])
+        if not deduped or deduped[-1] != coord:
+            deduped.append(coord)
+    return deduped
+
+
+class _CruiseTrack(Base):
+    """A precomputed resolution of a Cruise's track.
+
+    Level 0 is the full track without consecutive duplicate points. Each further
+    level is simplified with Douglas-Peucker at the tolerance in TOLERANCES.
+    They are calculated when the track is set so map requests do not need to
+    simplify tracks.
+
+    """
+    __tablename__ = 'cruise_tracks'
+
+    # Degrees
+    TOLERANCES = [0, 0.01, 0.05, 0.2, 1.0]
+
+    cruise_id = Column(
+        Integer, ForeignKey('cruises.id', ondelete='CASCADE'),
+        primary_key=True)
+    level = Column(Integer, primary_key=True, autoincrement=False)
+    num_coords = Column(Integer, nullable=False)
+    # JSON list of [lng, lat]
+    coords = Column(Unicode, nullable=False)
+
+    def __init__(self, level, coords):
+        self.level = level
+        self.num_coords = len(coords)
+        self.coords = unicode(dumps(coords))
+
+    @classmethod
+    def simplify(cls, track):
+        """Return a list of (level, coords) for the track."""
+        coords = _dedup_consecutive(track.coords)
+        levels = []
+        for level, tolerance in enumerate(cls.TOLERANCES):
+            if tolerance and len(coords) > 2:
+                simple = shape({'type': 'LineString', 'coordinates': coords}).\
+                    simplify(tolerance, preserve_topology=False)
+                coords = _dedup_consecutive(simple.coords)
+            levels.append((level, coords))
+        return levels
+
+    @classmethod
+    def level_for_zoom(cls, zoom):
+        """Return the coarsest level that does not lose a pixel at zoom.
+
+        zoom - a web map zoom level, the world is 256 * 2 ** zoom pixels wide
+
+        """
+        pixel = 360.0 / (256 * 2 ** zoom)
+        level = 0
+        for lll, tolerance in enumerate(cls.TOLERANCES):
+            if tolerance <= pixel:
+                level = lll
+        return level
+
+
 class Cruise(Obj):
     """The basic unit of metadata storage.
 
@@ -2735,6 +3445,9 @@ class Cruise(Obj):
     id = Column(Integer, ForeignKey('objs.id'), primary_key=True)
     expocode = Column(String)
 
+    _tracks = relationship(
+        _CruiseTrack, cascade='all, delete-orphan', passive_deletes=True)
+
     _aliases = relationship(_CruiseAlias, lazy='subquery', uselist=True)
     aliases = association_proxy('_aliases', 'alias')
 
@@ -2745,6 +3458,10 @@ class Cruise(Obj):
         collection_class=attribute_mapped_collection('attr'),
         lazy='subquery', cascade='all, delete-orphan')
 
+    _data_update = relationship(
+        _CruiseDataUpdate, uselist=False, cascade='all, delete-orphan',
+        passive_deletes=True)
+
     date_start = Column(DateTime)
     date_end = Column(DateTime)
 
@@ -2795,9 +3512,9 @@ class Cruise(Obj):
         attributes may cause it to be considered preliminary as well.
 
         """
-        for attr, change in self.attrs_current.items():
+        for attr, current in self._current_attrs.items():
             if attr.endswith(self.DATA_STATUS_ENDING):
-                if 'preliminary' in change.value:
+                if 'preliminary' in self.deserialize(attr, current.value):
                     return True
         return 'preliminary' in self.get('statuses', []) 
 
@@ -2812,33 +3529,157 @@ class Cruise(Obj):
     def woce_lines(self):
         return filter(lambda www: www.type == 'WOCE line', self.collections)
 
+    # The decoded track and the stored value it was decoded from
+    _decoded_track = None
+
     @property
     def track(self):
-        if self._track is not None:
-            return to_shape(self._track)
-        return None
+        if self._track is None:
+            return None
+        decoded = self._decoded_track
+        if decoded is None or decoded[0] is not self._track:
+            decoded = self._decoded_track = (
+                self._track, to_shape(self._track))
+        return decoded[1]
 
     @track.setter
     def track(self, value):
         self._track = from_shape(value)
+        self._decoded_track = (self._track, value)
+        self._tracks = [
+            _CruiseTrack(level, coords) for level, coords in
+            _CruiseTrack.simplify(value)]
+
+    @classmethod
+    def simplified_tracks(cls, cruise_ids, max_coords=None, zoom=None,
+                          level=None):
+        """Return the precomputed track coordinates for many cruises.
+
+        The resolution is level if given or the one for zoom. Otherwise, it is
+        the most detailed one with at most max_coords coordinates or, if none
+        are that small, the least detailed.
+
+        Returns a dict of cruise id to list of [lng, lat].
+
+        """
+        if not cruise_ids:
+            return {}
+        query = DBSession.query(_CruiseTrack.cruise_id, _CruiseTrack.coords).\
+            filter(_CruiseTrack.cruise_id.in_(cruise_ids))
+        if level is None and zoom is not None:
+            level = _CruiseTrack.level_for_zoom(zoom)
+        if level is not None:
+            query = query.filter(_CruiseTrack.level == level)
+        else:
+            level = _CruiseTrack.level
+            fits = _CruiseTrack.num_coords <= max_coords
+            query = query.distinct(_CruiseTrack.cruise_id).order_by(
+                _CruiseTrack.cruise_id, case([(fits, 0)], else_=1),
+                case([(fits, level)], else_=-level))
+        return dict((cruise_id, loads(coords)) for cruise_id, coords in query)
+
+    @classmethod
+    def rebuild_tracks(cls, batch_size=1000):
+        """Recalculate the track resolutions for all cruises."""
+        table = _CruiseTrack.__table__
+        DBSession.execute(table.delete())
+        rows = []
+        query = DBSession.query(cls.id, cls._track).\
+            filter(cls._track != None)
+        for cruise_id, track in query.yield_per(100):
+            for level, coords in _CruiseTrack.simplify(to_shape(track)):
+                rows.append(dict(
+                    cruise_id=cruise_id, level=level, num_coords=len(coords),
+                    coords=unicode(dumps(coords))))
+            if len(rows) >= batch_size:
+                DBSession.execute(table.insert(), rows)
+                rows = []
+        if rows:
+            DBSession.execute(table.insert(), rows)
+        mark_changed(DBSession())
 
     @property
     def attrs_current(self):
         changes = {}
-        keys = [key for key, av in self._allowed_attrs().items()]
+        keys = self._attr_schemas().keys()
         for change in self.get_attrs_or(keys):
             changes[change.attr] = change
         return changes
 
+    # Map from file attr to its current Change filled by prefetch_file_attrs.
+    # Set per instance.
+    _file_attrs = None
+
     @property
     def file_attrs(self):
-        file_attrs = copy(self.files)
-        for key, val in file_attrs.items():
-            attr = val._attr
-            if not attr:
-                attr = self.get_attr_or(key)
-            file_attrs[key] = attr
-        return file_attrs
+        """Return a dict from file attr to the Change holding the file."""
+        if self._file_attrs is None:
+            self.prefetch_file_attrs([self])
+        return copy(self._file_attrs)
+
+    @classmethod
+    def prefetch_file_attrs(cls, cruises):
+        """Resolve the file Changes for many cruises with one query.
+
+        The cruise files are loaded along with the Change they refer to. Cruise
+        files that do not refer to a Change use the current Change for the file
+        attr instead.
+
+        """
+        cruises = filter(None, cruises)
+        if not cruises:
+            return
+        id_cruises = dict((cruise.id, cruise) for cruise in cruises)
+
+        rows = DBSession.query(_CruiseFile, Change).\
+            outerjoin(_ObjCurrentAttr, and_(
+                _CruiseFile._attr_id == None,
+                _ObjCurrentAttr.obj_id == _CruiseFile.cruise_id,
+                _ObjCurrentAttr.attr == _CruiseFile.attr)).\
+            outerjoin(Change, Change.id == _ObjCurrentAttr.change_id).\
+            filter(_CruiseFile.cruise_id.in_(id_cruises.keys())).all()
+
+        files = dict((cruise_id, []) for cruise_id in id_cruises)
+        file_attrs = dict((cruise_id, {}) for cruise_id in id_cruises)
+        for cfile, change in rows:
+            files[cfile.cruise_id].append(cfile)
+            file_attrs[cfile.cruise_id][cfile.attr] = cfile._attr or change
+        for cruise_id, cruise in id_cruises.items():
+            if 'files' not in cruise.__dict__:
+                set_committed_value(cruise, 'files', files[cruise_id])
+            cruise._file_attrs = file_attrs[cruise_id]
+
+    def _forget_prefetched(self, attr):
+        super(Cruise, self)._forget_prefetched(attr)
+        self._file_attrs = None
+
+    # File attrs whose acceptance counts as an update to the cruise's dataset
+    UPDATED_ATTRS = frozenset(
+        set(data_file_descriptions.keys()) - set(['map_thumb', 'map_full']))
+
+    def _change_accepted(self, change):
+        super(Cruise, self)._change_accepted(change)
+        if change.attr not in self.UPDATED_ATTRS:
+            return
+        if self._data_update is None:
+            self._data_update = _CruiseDataUpdate(change)
+        else:
+            self._data_update.change = change
+            self._data_update.ts_j = change.ts_j
+
+    def _change_rejected(self, change):
+        super(Cruise, self)._change_rejected(change)
+        if (self._data_update is None or
+                self._data_update.change is not change):
+            return
+        latest = self._order_changes(self.changes_query('accepted').\
+            filter(Change.attr.in_(list(self.UPDATED_ATTRS))).\
+            filter(Change.id != change.id)).first()
+        if latest is None:
+            self._data_update = None
+        else:
+            self._data_update.change = latest
+            self._data_update.ts_j = latest.ts_j
 
     def _set_cache(self, change, value):
         """Set the attribute value to cache."""
@@ -2846,16 +3687,20 @@ class Cruise(Obj):
         if attr == 'participants':
             self.participants = set(value)
             return
-        elif attr.endswith(self.DATA_STATUS_ENDING):
+        schema = self._attr_schema(attr)
+        if schema.is_status or schema.is_file:
+            self._file_attrs = None
+        if schema.is_status:
             attr = attr[:-len(self.DATA_STATUS_ENDING)]
             try:
                 self.files[attr].statuses = value
             except KeyError:
                 self.files[attr] = _CruiseFile(attr, None, value)
             return
-        elif self.attr_type(attr) == File:
+        elif schema.is_file:
             try:
-                cfile = self.files[attr].file = value
+                cfile = self.files[attr]
+                cfile.file = value
             except KeyError:
                 cfile = self.files[attr] = _CruiseFile(attr, value)
             cfile._attr = change
@@ -2864,11 +3709,12 @@ class Cruise(Obj):
 
     def _get_cache(self, attr):
         """Attempt to get the attribute value from cache."""
+        schema = self._attr_schema(attr)
         try:
-            if attr.endswith(self.DATA_STATUS_ENDING):
+            if schema.is_status:
                 attr = attr[:-len(self.DATA_STATUS_ENDING)]
                 return self.files[attr].statuses
-            if self.attr_type(attr) == File:
+            if schema.is_file:
                 return self.files[attr].file
         except KeyError:
             pass
@@ -2891,63 +3737,182 @@ class Cruise(Obj):
     def get_all_by_expocode(cls, expocode, *args):
         return cls.query_by_expocode(expocode).options(*args).all()
 
+    # identifier -> cruise id, per worker. Invalidated when Cruise identifiers
+    # change in this process; the TTL bounds staleness from other workers.
+    _identifier_cache = LRUCache(size=4096, ttl=60)
+
+    # Whether this worker has seen cruise_identifiers filled
+    _identifiers_built = False
+
+    @classmethod
+    def _has_identifiers(cls):
+        """Whether the identifier lookup table exists and has been filled.
+
+        Databases from before the table was added only have it once
+        rebuild_identifiers has been run.
+
+        """
+        if not cls._identifiers_built:
+            connection = DBSession.connection()
+            table = _CruiseIdentifier.__table__
+            if connection.dialect.has_table(
+                    connection, table.name, schema=table.schema):
+                cls._identifiers_built = DBSession.query(
+                    _CruiseIdentifier.id).limit(1).first() is not None
+        return cls._identifiers_built
+
+    @classmethod
+    def _resolve_identifiers_by_attrs(cls, identifiers):
+        """Map identifiers to Cruise ids without the lookup table.
+
+        Each identifier is tried as an id, then an ExpoCode and then an alias
+        of an accepted Cruise, one identifier at a time.
+
+        """
+        resolved = {}
+        for ident in identifiers:
+            cruise = None
+            try:
+                cruise = cls.query().get(int(ident))
+            except ValueError:
+                pass
+            if not cruise:
+                cruise = cls.get_by_expocode(ident)
+            if not cruise:
+                cruise = cls.query().filter(cls.aliases.contains(ident)).\
+                    filter(cls.accepted == True).first()
+            if cruise:
+                resolved[ident] = cruise.id
+        return resolved
+
+    @classmethod
+    def _resolve_identifiers(cls, identifiers):
+        """Map identifiers to Cruise ids using a single query for the misses.
+
+        Until the lookup table has been filled, the misses are looked up by
+        their attrs instead.
+
+        Identifiers that do not match any Cruise are left out.
+
+        """
+        resolved = {}
+        misses = []
+        for ident in identifiers:
+            cruise_id = cls._identifier_cache.get(ident)
+            if cruise_id is None:
+                misses.append(ident)
+            else:
+                resolved[ident] = cruise_id
+        if not misses:
+            return resolved
+
+        if not cls._has_identifiers():
+            found = cls._resolve_identifiers_by_attrs(misses)
+            for ident, cruise_id in found.items():
+                cls._identifier_cache.set(ident, cruise_id)
+            resolved.update(found)
+            return resolved
+
+        precedence = case(
+            [(_CruiseIdentifier.kind == kind, iii) for iii, kind in
+             enumerate(_CruiseIdentifier.KINDS)])
+        query = DBSession.query(
+            _CruiseIdentifier.identifier, _CruiseIdentifier.cruise_id).\
+            filter(_CruiseIdentifier.identifier.in_(misses)).\
+            distinct(_CruiseIdentifier.identifier).\
+            order_by(_CruiseIdentifier.identifier, precedence,
+                     _CruiseIdentifier.cruise_id)
+        for ident, cruise_id in query:
+            cls._identifier_cache.set(ident, cruise_id)
+            resolved[ident] = cruise_id
+        return resolved
+
+    @classmethod
+    def get_by_ids(cls, identifiers):
+        """Retrieve cruises given a list of ids, ExpoCodes or aliases.
+
+        Cruises are returned in the same order as the identifiers.
+
+        Raises:
+            ValueError - if any of the identifiers is not found
+
+        """
+        identifiers = [unicode(ident) for ident in identifiers]
+        resolved = cls._resolve_identifiers(uniquify(identifiers))
+        if len(resolved) < len(set(identifiers)):
+            raise ValueError('Not found')
+
+        cruise_ids = uniquify(resolved.values())
+        cruises = dict(
+            (cruise.id, cruise) for cruise in
+            cls.query().filter(cls.id.in_(cruise_ids)).all())
+        if len(cruises) < len(cruise_ids):
+            # The cache is stale.
+            for ident in identifiers:
+                cls._identifier_cache.invalidate(ident)
+            raise ValueError('Not found')
+        return [cruises[resolved[ident]] for ident in identifiers]
+
     @classmethod
     def get_by_id(cls, cruise_id):
         """Retrieve a cruise given an id. The id may be a number or uid."""
-        cruise_obj = None
         if not cruise_id:
             return None
+        return cls.get_by_ids([cruise_id])[0]
 
-        try:
-            cid = int(cruise_id)
-            cruise_obj = Cruise.query().get(cid)
-        except ValueError:
-            pass
+    @classmethod
+    def rebuild_identifiers(cls):
+        """Recalculate the identifier lookup table for all cruises.
 
-        # If the id does not refer to a Cruise, try searching based on ExpoCode
-        if not cruise_obj:
-            cruise_obj = Cruise.get_by_expocode(cruise_id)
-        if not cruise_obj:
-            # If not, try based on aliases.
-            cruise_obj = Cruise.query().filter(
-                Cruise.aliases.contains(cruise_id)).filter(
-                Cruise.accepted == True).first()
+        Existing databases need this run once, e.g. with
+        pycchdo_rebuild_caches identifiers. Until then, identifiers are looked
+        up by the Cruise attrs one at a time.
 
-        if not cruise_obj:
-            raise ValueError('Not found')
-        return cruise_obj
+        """
+        ids = DBSession.query(
+            cast(Cruise.id, Unicode), literal('id'), Cruise.id)
+        expocodes = DBSession.query(
+            cast(Cruise.expocode, Unicode), literal('expocode'), Cruise.id).\
+            filter(Cruise.expocode != None)
+        aliases = DBSession.query(
+            _CruiseAlias.alias, literal('alias'), Cruise.id).\
+            join(Cruise, Cruise.id == _CruiseAlias.cruise_id).\
+            filter(Cruise.accepted == True).\
+            filter(_CruiseAlias.alias != None).distinct()
+        table = _CruiseIdentifier.__table__
+        DBSession.execute(table.delete())
+        DBSession.execute(table.insert().from_select(
+            ['identifier', 'kind', 'cruise_id'],
+            union_all(ids.statement, expocodes.statement, aliases.statement)))
+        mark_changed(DBSession())
+        cls._identifier_cache.invalidate()
 
     @classmethod
     def updated(cls, limit):
-        """Provide list of Changes that have been recently approved."""
-        file_types = data_file_descriptions.keys()
-        file_types.remove('map_thumb')
-        file_types.remove('map_full')
-
-        baseq = cls._order_changes(Change.query().\
-            filter(Change.accepted == True).\
-            filter(Change.attr.in_(file_types))).\
-            options(subqueryload(Change.obj))
-
-        skip = 0
-        step = limit * 4
-        updated = []
-        cruise_ids = set()
-
-        while len(updated) < limit:
-            attrs = baseq.offset(skip).limit(step)
-            attrs = attrs.all()
-            if not attrs:
-                break
-            for attr in attrs:
-                cruise_id = attr.obj_id
-                if cruise_id not in cruise_ids:
-                    cruise_ids.add(cruise_id)
-                    updated.append(attr)
-                if len(updated) >= limit:
-                    break
-            skip += step
-        return updated
+        """Provide list of Changes that have been recently approved.
+
+        Only the most recent data file Change for each cruise is listed.
+
+        """
+        return Change.query().join(
+            _CruiseDataUpdate, _CruiseDataUpdate.change_id == Change.id).\
+            order_by(_CruiseDataUpdate.ts_j.desc()).limit(limit).\
+            options(subqueryload(Change.obj)).all()
+
+    @classmethod
+    def rebuild_data_updates(cls):
+        """Recalculate the most recent data file Change for all cruises."""
+        latest = filter_query_change(DBSession.query(
+            Change.obj_id, Change.id, Change.ts_j), 'accepted').\
+            join(Cruise, Cruise.id == Change.obj_id).\
+            filter(Change.attr.in_(list(cls.UPDATED_ATTRS))).\
+            distinct(Change.obj_id).\
+            order_by(Change.obj_id, Change.ts_j.desc())
+        table = _CruiseDataUpdate.__table__
+        DBSession.execute(table.delete())
+        DBSession.execute(table.insert().from_select(
+            ['cruise_id', 'change_id', 'ts_j'], latest.statement))
+        mark_changed(DBSession())
 
     @classmethod
     def filter_pending_date_start(cls, query):
@@ -2962,21 +3927,22 @@ class Cruise(Obj):
         pending = cls.filter_pending_date_start(Cruise.query())
         return pending
 
+    # Front page listings of pending cruises, per worker.
+    _pending_cache = LRUCache(size=16, ttl=60)
+
     @classmethod
     def upcoming(cls, limit):
-        now = timestamp_now()
-        query = Cruise.pending_with_date_starts()
+        """Gives a list of the next limit pending cruises that have not started.
 
-        i = limit
-        hardlimit = query.count()
-        upcoming = []
-
-        while len(upcoming) < limit and i <= hardlimit:
-            upcoming = query.\
-                filter(Cruise.date_start >= func.now()).\
-                order_by(Cruise.date_start).limit(i).all()
-            i += limit
-        return upcoming[:limit]
+        """
+        key = ('upcoming', limit)
+        cruise_ids = cls._pending_cache.get(key)
+        if cruise_ids is not None:
+            return cls.get_all_by_ids(*cruise_ids)
+        upcoming = cls.pending_with_date_starts().\
+            filter(Cruise.date_start >= func.now()).limit(limit).all()
+        cls._pending_cache.set(key, [cruise.id for cruise in upcoming])
+        return upcoming
 
     @classmethod
     def pending_years(cls):
@@ -2984,11 +3950,78 @@ class Cruise(Obj):
         cruises.
 
         """
-        years = cls.filter_pending_date_start(
-            DBSession.query(distinct(Cruise.date_start))).\
-                filter(Cruise.date_start >= '{0}-01-01'.format(
-                    datetime.now().year)).all()
-        return uniquify([y[0].year for y in years])
+        years = cls._pending_cache.get('pending_years')
+        if years is not None:
+            return list(years)
+        year = extract('year', Cruise.date_start)
+        query = DBSession.query(year).\
+            filter(Cruise.ts_j == None).\
+            filter(Cruise.accepted == False).\
+            filter(Cruise.date_start >= '{0}-01-01'.format(
+                datetime.now().year)).\
+            distinct().order_by(year)
+        years = [int(y) for y, in query]
+        cls._pending_cache.set('pending_years', years)
+        return list(years)
+
+    # NODC country code prefix for USA ships
+    USA_SHIP_CODE_RE = '^3[1-3]'
+
+    @classmethod
+    def specifics_reduction_clause(cls):
+        """SQL for whether Cruises need their date and port specifics reduced
+        to comply with UNOLS and Navy security regulations.
+
+        These are the Cruises on USA ships that are in the future, same as
+        helpers.needs_specifics_reduction.
+
+        """
+        usa_ships = select([Ship.id]).where(
+            Ship.nodc_platform_code.op('~')(cls.USA_SHIP_CODE_RE))
+        now = func.now()
+        return and_(
+            or_(cls.expocode.op('~')(cls.USA_SHIP_CODE_RE),
+                cls.ship_id.in_(usa_ships)),
+            or_(cls.date_start > now, cls.date_end > now))
+
+    @classmethod
+    def _reduced_dates(cls):
+        """SQL for the dates with only the year when specifics are reduced."""
+        needs_reduction = cls.specifics_reduction_clause()
+        return [
+            case([(needs_reduction, func.date_trunc('year', col))], else_=col)
+            for col in (cls.date_start, cls.date_end)]
+
+    @classmethod
+    def _set_reduced_dates(cls, cruise, date_start, date_end):
+        # Set as committed values so the reduced dates are never flushed.
+        if date_start != cruise.date_start:
+            set_committed_value(cruise, 'date_start', date_start)
+        if date_end != cruise.date_end:
+            set_committed_value(cruise, 'date_end', date_end)
+
+    @classmethod
+    def all_reduced_specifics(cls, query):
+        """Run a query for Cruises that also reduces their date specifics."""
+        cruises = []
+        for cruise, date_start, date_end in query.add_columns(
+                *cls._reduced_dates()):
+            cls._set_reduced_dates(cruise, date_start, date_end)
+            cruises.append(cruise)
+        return cruises
+
+    @classmethod
+    def reduce_specifics(cls, cruises):
+        """Reduce the date specifics of loaded Cruises with one query."""
+        by_id = dict((cruise.id, cruise) for cruise in cruises if cruise)
+        if not by_id:
+            return
+        query = DBSession.query(cls.id, *cls._reduced_dates()).\
+            filter(cls.id.in_(by_id.keys())).\
+            filter(cls.specifics_reduction_clause())
+        for cruise_id, date_start, date_end in query:
+            log.info(u'Reducing specifics for cruise {0}'.format(cruise_id))
+            cls._set_reduced_dates(by_id[cruise_id], date_start, date_end)
 
     @classmethod
     def load_cruise_options(cls, query):
@@ -3058,6 +4091,16 @@ class Cruise(Obj):
         return u'Cruise({0}, {1})'.format(
             _repr_state(self), self.expocode)
 
+
+# Pending cruises are those that have never been judged. The conditions are on
+# separate tables so each gets its own partial index.
+Index('idx_objs_pending', Obj.__table__.c.id,
+      postgresql_where=and_(Obj.__table__.c.accepted == False,
+                            Obj.__table__.c.ts_j == None))
+Index('idx_cruises_date_start', Cruise.__table__.c.date_start,
+      postgresql_where=Cruise.__table__.c.date_start != None)
+
+
 def __allow_attr_cruise():
     cruise_allow_attrs = [
         ('expocode', Unicode, 'ExpoCode'),
@@ -3110,19 +4153,45 @@ def _deleted_note(mapper, connection, target):
     triggers.deleted_note(target)
 
 
+def _write_cruise_identifiers(connection, cruise, replace):
+    table = _CruiseIdentifier.__table__
+    if replace:
+        connection.execute(table.delete().where(table.c.cruise_id == cruise.id))
+    connection.execute(table.insert(), _CruiseIdentifier.rows_for(cruise))
+    Cruise._identifier_cache.invalidate()
+
+
+@event.listens_for(Cruise, 'after_insert')
+def _inserted_cruise(mapper, connection, target):
+    _write_cruise_identifiers(connection, target, False)
+    Cruise._pending_cache.invalidate()
+
+
+@event.listens_for(Cruise, 'after_update')
+def _updated_cruise(mapper, connection, target):
+    Cruise._pending_cache.invalidate()
+    for attr in ('expocode', 'accepted', '_aliases'):
+        if get_history(target, attr).has_changes():
+            _write_cruise_identifiers(connection, target, True)
+            return
+
+
+@event.listens_for(Cruise, 'after_delete')
+def _deleted_cruise(mapper, connection, target):
+    Cruise._identifier_cache.invalidate()
+    Cruise._pending_cache.invalidate()
+
+
 @event.listens_for(Obj, 'after_insert')
 @event.listens_for(Obj, 'after_update')
 def _saved_obj(mapper, connection, target):
-    if isinstance(target, Obj):
-        return
     triggers.saved_obj(target)
 
 
 @event.listens_for(Obj, 'after_delete')
 def _deleted_obj(mapper, connection, target):
-    if isinstance(target, Obj):
-        return
     triggers.deleted_obj(target)
 
 
 once_at_end.run()
+Obj.finalize_attr_schemas()
@@ -0,0 +1,285 @@
+"""Map tiles of all cruise tracks.
+
+Tiles use the web map z/x/y scheme and are GeoJSON FeatureCollections of the
+cruise tracks clipped to the tile. Built tiles are kept on disk until a cruise
+that passes through them changes or until they expire.
+
+"""
+import os
+import os.path
+import json
+import math
+from time import time
+from tempfile import mkstemp
+from weakref import WeakSet
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history
+
+from shapely.geometry import box, mapping
+from shapely.prepared import prep
+
+from geoalchemy2.shape import to_shape
+
+from pycchdo.models.serial import DBSession, Session, Cruise
+from pycchdo.models.tracks import split_at_dateline
+from pycchdo.log import getLogger
+
+
+log = getLogger(__name__)
+
+
+MAX_ZOOM = 12
+
+
+# Seconds that a cached tile is used for. Changes made by processes that do not
+# invalidate this cache, and cruises that the track index has not picked up yet,
+# are only reflected once the tile expires.
+TILE_TTL = 24 * 3600
+
+
+def _lat_for_y(y, zoom):
+    """Latitude of the north edge of tile row y."""
+    n = math.pi - 2 * math.pi * y / 2 ** zoom
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+def _y_for_lat(lat, zoom):
+    lat = max(min(lat, 85.0511), -85.0511)
+    rad = math.radians(lat)
+    yyy = (1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2
+    return min(int(yyy * 2 ** zoom), 2 ** zoom - 1)
+
+
+def _x_for_lng(lng, zoom):
+    xxx = (lng + 180.0) / 360.0
+    return max(min(int(xxx * 2 ** zoom), 2 ** zoom - 1), 0)
+
+
+def tile_bounds(zoom, x, y):
+    """Return the (west, south, east, north) of a tile in degrees."""
+    size = 360.0 / 2 ** zoom
+    return (x * size - 180, _lat_for_y(y + 1, zoom),
+            (x + 1) * size - 180, _lat_for_y(y, zoom))
+
+
+def tile_ranges(bounds, zoom):
+    """Return the x and y ranges of tiles that cover bounds at zoom."""
+    west, south, east, north = bounds
+    return (xrange(_x_for_lng(west, zoom), _x_for_lng(east, zoom) + 1),
+            xrange(_y_for_lat(north, zoom), _y_for_lat(south, zoom) + 1))
+
+
+def valid_tile(zoom, x, y):
+    return 0 <= zoom <= MAX_ZOOM and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom
+
+
+# All TrackTiles in this process so that Cruise changes can reach them.
+_track_tiles = WeakSet()
+
+
+class TrackTiles(object):
+    """GeoJSON tiles of cruise tracks with an on-disk cache.
+
+    Tiles are built from the track index candidates and the precomputed track
+    resolution for the zoom. Features have the cruise id, expocode and year.
+
+    The cache is shared by all processes that use the same path. When a
+    cruise's track, expocode or start date changes, the cached tiles that the
+    old or new track passes through are removed once the transaction commits.
+
+    Every invalidation also increases the cache generation. A tile that was
+    being built while the generation changed may hold data from before the
+    change and is not kept.
+
+    """
+    def __init__(self, track_index, path=None, ttl=TILE_TTL):
+        """path - the cache directory. If None, tiles are not cached.
+        ttl - seconds that a cached tile is used for.
+
+        """
+        self.track_index = track_index
+        self.path = path
+        self.ttl = ttl
+        _track_tiles.add(self)
+
+    def _tile_path(self, zoom, x, y):
+        return os.path.join(
+            self.path, str(zoom), str(x), '{0}.json'.format(y))
+
+    def _generation_path(self):
+        return os.path.join(self.path, 'generation')
+
+    def generation(self):
+        """Return the number of times that the cache was invalidated."""
+        try:
+            return os.path.getsize(self._generation_path())
+        except OSError:
+            return 0
+
+    def _next_generation(self):
+        _makedirs(self.path)
+        # Appends are atomic so every process sees every increase.
+        with open(self._generation_path(), 'a') as fff:
+            fff.write('.')
+
+    def get(self, zoom, x, y):
+        """Return the GeoJSON of a tile."""
+        if not self.path:
+            return self.build(zoom, x, y)
+        path = self._tile_path(zoom, x, y)
+        try:
+            if time() - os.path.getmtime(path) < self.ttl:
+                with open(path) as fff:
+                    return fff.read()
+        except (IOError, OSError):
+            pass
+        generation = self.generation()
+        tile = self.build(zoom, x, y)
+        self._write(path, tile, generation)
+        return tile
+
+    def _write(self, path, tile, generation):
+        """Cache a tile that was built in generation."""
+        dirname = os.path.dirname(path)
+        _makedirs(dirname)
+        # Write to the side and rename so readers never see partial tiles.
+        fd, temp_path = mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as fff:
+            fff.write(tile)
+        os.rename(temp_path, path)
+        # Invalidations increase the generation before removing tiles. If it
+        # has not changed yet, any later invalidation will remove this tile.
+        if self.generation() != generation:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def build(self, zoom, x, y):
+        """Build the GeoJSON of a tile."""
+        tile_box = box(*tile_bounds(zoom, x, y))
+        cruise_ids = self.track_index.cruise_ids_in(tile_box)
+        features = []
+        if cruise_ids:
+            tracks = Cruise.simplified_tracks(cruise_ids, zoom=zoom)
+            missing = [cid for cid in cruise_ids if cid not in tracks]
+            if missing:
+                # Simplified tracks have not been built for these yet.
+                for cid, track in DBSession.query(Cruise.id, Cruise._track).\
+                        filter(Cruise.id.in_(missing)):
+                    tracks[cid] = list(to_shape(track).coords)
+            query = DBSession.query(
+                Cruise.id, Cruise.expocode, Cruise.date_start).\
+                filter(Cruise.id.in_(tracks.keys())).order_by(Cruise.id)
+            for cruise_id, expocode, date_start in query:
+                clipped = split_at_dateline(tracks[cruise_id]).intersection(
+                    tile_box)
+                if clipped.is_empty:
+                    continue
+                try:
+                    year = date_start.year
+                except AttributeError:
+                    year = None
+                features.append({
+                    'type': 'Feature',
+                    'geometry': mapping(clipped),
+                    'properties': {
+                        'id': cruise_id,
+                        'expocode': expocode,
+                        'year': year,
+                    },
+                })
+        return json.dumps(
+            {'type': 'FeatureCollection', 'features': features},
+            separators=(',', ':'))
+
+    def invalidate(self, geoms):
+        """Remove the cached tiles that any of the geometries pass through."""
+        if not self.path:
+            return
+        self._next_generation()
+        for geom in geoms:
+            prepared = prep(geom)
+            for zoom in range(MAX_ZOOM + 1):
+                zoom_path = os.path.join(self.path, str(zoom))
+                try:
+                    xs = os.listdir(zoom_path)
+                except OSError:
+                    continue
+                x_range, y_range = tile_ranges(geom.bounds, zoom)
+                for x in xs:
+                    if int(x) not in x_range:
+                        continue
+                    for name in os.listdir(os.path.join(zoom_path, x)):
+                        try:
+                            y = int(name.split('.')[0])
+                        except ValueError:
+                            continue
+                        if y not in y_range:
+                            continue
+                        bounds = tile_bounds(zoom, int(x), y)
+                        if prepared.intersects(box(*bounds)):
+                            try:
+                                os.unlink(os.path.join(zoom_path, x, name))
+                            except OSError:
+                                pass
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _track_geom(value):
+    if value is None:
+        return None
+    return split_at_dateline(list(to_shape(value).coords))
+
+
+def _mark_tracks(target, values):
+    session = object_session(target)
+    if session is None:
+        return
+    geoms = session.info.setdefault('changed_track_geoms', [])
+    for value in values:
+        geom = _track_geom(value)
+        if geom is not None:
+            geoms.append(geom)
+
+
+@event.listens_for(Cruise, 'after_insert')
+@event.listens_for(Cruise, 'after_update')
+def _saved_cruise_track(mapper, connection, target):
+    history = get_history(target, '_track')
+    if history.has_changes():
+        _mark_tracks(target, list(history.added) + list(history.deleted))
+        return
+    # Features carry the expocode and year as well.
+    for attr in ('expocode', 'date_start'):
+        if get_history(target, attr).has_changes():
+            _mark_tracks(target, [target._track])
+            return
+
+
+@event.listens_for(Cruise, 'after_delete')
+def _deleted_cruise_track(mapper, connection, target):
+    _mark_tracks(target, [target._track])
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_tiles(session):
+    geoms = session.info.pop('changed_track_geoms', None)
+    if not geoms:
+        return
+    for tiles in list(_track_tiles):
+        tiles.invalidate(geoms)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changed_tracks(session, previous_transaction):
+    session.info.pop('changed_track_geoms', None)
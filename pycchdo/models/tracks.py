@@ -0,0 +1,352 @@
+"""Geometry of many cruise tracks at once.
+
+PackedTracks runs vectorized tests over many tracks. TrackIndex is a per-worker
+spatial index of all cruise tracks.
+
+"""
+from collections import namedtuple
+from datetime import timedelta
+from threading import Lock
+from weakref import WeakSet
+
+import numpy as np
+
+from sqlalchemy.sql import func
+
+from shapely.geometry import LineString, MultiLineString
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from geoalchemy2.shape import to_shape
+
+from pycchdo.models import triggers
+from pycchdo.models.serial import DBSession, Cruise, CruiseDateFilter
+from pycchdo.log import getLogger
+
+
+log = getLogger(__name__)
+
+
+def _cross(ox, oy, ax, ay, bx, by):
+    """z component of (a - o) x (b - o)"""
+    return (ax - ox) * (by - oy) - (ay - oy) * (bx - ox)
+
+
+class PackedTracks(object):
+    """The coordinates of many tracks packed into flat arrays.
+
+    The coordinates of track i are lngs[offsets[i]:offsets[i + 1]] and
+    lats[offsets[i]:offsets[i + 1]].
+
+    All tests return a boolean mask over the tracks that is True where any part
+    of the track passes.
+
+    """
+    def __init__(self, tracks):
+        """tracks - a list of lists of [lng, lat]"""
+        lengths = [len(track) for track in tracks]
+        self.offsets = np.zeros(len(tracks) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=self.offsets[1:])
+        coords = np.array(
+            [coord[:2] for track in tracks for coord in track],
+            dtype=np.float64).reshape(-1, 2)
+        self.lngs = coords[:, 0]
+        self.lats = coords[:, 1]
+
+    @classmethod
+    def from_cruises(cls, cruises):
+        """Pack the full resolution tracks of cruises.
+
+        Cruises without a track get an empty track that never passes.
+
+        """
+        simplified = Cruise.simplified_tracks(
+            [cruise.id for cruise in cruises], level=0)
+        tracks = []
+        for cruise in cruises:
+            try:
+                tracks.append(simplified[cruise.id])
+            except KeyError:
+                track = cruise.track
+                if track is None:
+                    tracks.append([])
+                else:
+                    tracks.append(list(track.coords))
+        return cls(tracks)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _any_per_track(self, point_mask):
+        """Reduce a mask over all coordinates to a mask over the tracks."""
+        starts = self.offsets[:-1]
+        nonempty = self.offsets[1:] > starts
+        mask = np.zeros(len(self), dtype=bool)
+        if point_mask.size:
+            mask[nonempty] = np.logical_or.reduceat(
+                point_mask, starts[nonempty])
+        return mask
+
+    def _segments(self):
+        """Return the segment endpoints and whether each is within a track."""
+        valid = np.ones(max(self.lngs.size - 1, 0), dtype=bool)
+        # The segments from the end of one track to the start of the next
+        ends = self.offsets[1:-1] - 1
+        valid[ends[(ends >= 0) & (ends < valid.size)]] = False
+        # Segments that jump across the dateline do not span the globe.
+        valid &= np.abs(self.lngs[1:] - self.lngs[:-1]) <= 180
+        return (self.lngs[:-1], self.lats[:-1], self.lngs[1:], self.lats[1:],
+                valid)
+
+    def in_rectangle(self, sw, ne):
+        """Test for coordinates in the rectangle [sw, ne).
+
+        If the west edge is east of the east edge, the rectangle crosses the
+        dateline.
+
+        """
+        west, south = sw
+        east, north = ne
+        lngs, lats = self.lngs, self.lats
+        if west > east:
+            in_lng = (((west <= lngs) & (lngs < 180)) |
+                      ((-180 <= lngs) & (lngs < east)))
+        else:
+            in_lng = (west <= lngs) & (lngs < east)
+        return self._any_per_track(in_lng & (south <= lats) & (lats < north))
+
+    def _contains_points(self, vertices):
+        """Crossing number test of all coordinates in the polygon."""
+        lngs, lats = self.lngs, self.lats
+        inside = np.zeros(lngs.size, dtype=bool)
+        jjj = len(vertices) - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for iii in range(len(vertices)):
+                x1, y1 = vertices[iii][:2]
+                x2, y2 = vertices[jjj][:2]
+                crosses = ((y1 > lats) != (y2 > lats)) & (
+                    lngs < (x2 - x1) * (lats - y1) / (y2 - y1) + x1)
+                inside ^= crosses
+                jjj = iii
+        return inside
+
+    def _crosses_edges(self, vertices):
+        """Test all track segments for intersection with the polygon edges."""
+        ax, ay, bx, by, valid = self._segments()
+        crossing = np.zeros(valid.size, dtype=bool)
+        jjj = len(vertices) - 1
+        for iii in range(len(vertices)):
+            cx, cy = vertices[jjj][:2]
+            dx, dy = vertices[iii][:2]
+            d1 = _cross(cx, cy, dx, dy, ax, ay)
+            d2 = _cross(cx, cy, dx, dy, bx, by)
+            d3 = _cross(ax, ay, bx, by, cx, cy)
+            d4 = _cross(ax, ay, bx, by, dx, dy)
+            overlap = ((np.maximum(ax, bx) >= min(cx, dx)) &
+                       (np.minimum(ax, bx) <= max(cx, dx)) &
+                       (np.maximum(ay, by) >= min(cy, dy)) &
+                       (np.minimum(ay, by) <= max(cy, dy)))
+            crossing |= (d1 * d2 <= 0) & (d3 * d4 <= 0) & overlap
+            jjj = iii
+        point_mask = np.zeros(self.lngs.size, dtype=bool)
+        point_mask[:-1] = crossing & valid
+        return point_mask
+
+    def in_polygon(self, vertices):
+        """Test for tracks that intersect the polygon.
+
+        vertices - the polygon exterior as a list of [lng, lat]
+
+        """
+        return (self._any_per_track(self._contains_points(vertices)) |
+                self._any_per_track(self._crosses_edges(vertices)))
+
+
+def split_at_dateline(coords):
+    """Split a track where it jumps across the dateline.
+
+    Returns a LineString or, if the track jumps, a MultiLineString.
+
+    """
+    parts = [[]]
+    for coord in coords:
+        coord = tuple(coord[:2])
+        if parts[-1] and abs(coord[0] - parts[-1][-1][0]) > 180:
+            parts.append([])
+        parts[-1].append(coord)
+    # Single points still need to be lines.
+    parts = [part if len(part) > 1 else part * 2 for part in parts]
+    if len(parts) == 1:
+        return LineString(parts[0])
+    return MultiLineString(parts)
+
+
+_IndexedTrack = namedtuple('_IndexedTrack', ['geom', 'date_start', 'date_end'])
+
+
+# All TrackIndexes in this process so that Cruise changes can reach them.
+_track_indexes = WeakSet()
+
+
+class TrackIndex(object):
+    """A per-worker spatial index of all cruise tracks.
+
+    Candidate cruises for a selection come from an STRtree of the tracks and
+    are confirmed with the prepared selection geometry. Only the matching
+    cruises are loaded from the database.
+
+    Before each query, the index reloads the cruises modified since it was last
+    brought up to date. Cruises saved or deleted in this process, as reported
+    by the model triggers, are reloaded as well. When nothing has changed, this
+    is two queries on objs.mtime.
+
+    A cruise's mtime is set when it is changed, not when the change commits, so
+    the cruises modified up to REFRESH_LAG before the last refresh are checked
+    again. Those whose mtime differs from the one last seen are reloaded.
+
+    """
+    # Longest expected time between changing a cruise and committing it
+    REFRESH_LAG = timedelta(hours=1)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._tracks = {}
+        self._tree = None
+        self._tree_ids = []
+        self._tree_positions = {}
+        self._mtime = None
+        self._mtimes = {}
+        self._dirty_ids = set()
+        _track_indexes.add(self)
+
+    def invalidate(self, cruise_id):
+        """Reload the cruise before the next query."""
+        with self._lock:
+            self._dirty_ids.add(cruise_id)
+
+    def _load(self, cruise_ids=None):
+        """Load the tracks of the cruises, or of all cruises if None."""
+        query = DBSession.query(
+            Cruise.id, Cruise.date_start, Cruise.date_end).\
+            filter(Cruise._track != None)
+        if cruise_ids is not None:
+            if not cruise_ids:
+                return
+            query = query.filter(Cruise.id.in_(cruise_ids))
+        dates = dict((cid, (start, end)) for cid, start, end in query)
+        simplified = Cruise.simplified_tracks(dates.keys(), level=0)
+        missing = [cid for cid in dates if cid not in simplified]
+        if missing:
+            for cid, track in DBSession.query(Cruise.id, Cruise._track).\
+                    filter(Cruise.id.in_(missing)):
+                simplified[cid] = list(to_shape(track).coords)
+        for cid, (start, end) in dates.items():
+            self._tracks[cid] = _IndexedTrack(
+                split_at_dateline(simplified[cid]), start, end)
+
+    def _recent_mtimes(self, latest):
+        """Return the mtimes of the cruises in the refresh window."""
+        if latest is None:
+            return {}
+        since = self._mtime
+        if since is None:
+            since = latest
+        return dict(DBSession.query(Cruise.id, Cruise.mtime).filter(
+            Cruise.mtime >= since - self.REFRESH_LAG))
+
+    def _refresh(self):
+        latest = DBSession.query(func.max(Cruise.mtime)).scalar()
+        recent = self._recent_mtimes(latest)
+        if self._tree is not None:
+            changed = set(self._dirty_ids)
+            changed |= set(cid for cid, mtime in recent.items()
+                           if self._mtimes.get(cid) != mtime)
+            if not changed:
+                return
+            for cid in changed:
+                self._tracks.pop(cid, None)
+            self._load(list(changed))
+        else:
+            log.info(u'Building cruise track index')
+            self._tracks = {}
+            self._load()
+        self._dirty_ids = set()
+        self._mtime = latest
+        self._mtimes = recent
+
+        self._tree_ids = self._tracks.keys()
+        geoms = [self._tracks[cid].geom for cid in self._tree_ids]
+        self._tree_positions = dict(
+            (id(geom), iii) for iii, geom in enumerate(geoms))
+        if geoms:
+            self._tree = STRtree(geoms)
+        else:
+            self._tree = False
+
+    def cruise_ids_in(self, selection, time_range=None):
+        """Return the ids of cruises whose tracks intersect the selection.
+
+        time_range - if given, only cruises in the (start, end) years
+
+        """
+        with self._lock:
+            self._refresh()
+            tree = self._tree
+            tree_ids = self._tree_ids
+            positions = self._tree_positions
+            tracks = self._tracks
+        if not tree:
+            return []
+
+        prepared = prep(selection)
+        if time_range:
+            date_filter = CruiseDateFilter(time_range)
+        else:
+            date_filter = lambda track: True
+        cruise_ids = []
+        for item in tree.query(selection):
+            # Older shapely gives geometries, newer gives positions.
+            if isinstance(item, BaseGeometry):
+                cid = tree_ids[positions[id(item)]]
+            else:
+                cid = tree_ids[int(item)]
+            track = tracks[cid]
+            if date_filter(track) and prepared.intersects(track.geom):
+                cruise_ids.append(cid)
+        return sorted(cruise_ids)
+
+    def cruises_in_selection(self, selection, time_range,
+                             roi_result_limit=None):
+        """Return cruises in selected polygon and time range.
+
+        Same as Cruise.cruises_in_selection but from the index.
+
+        """
+        cruise_ids = self.cruise_ids_in(selection, time_range)
+        limited = False
+        if roi_result_limit is not None and \
+                len(cruise_ids) > roi_result_limit:
+            cruise_ids = cruise_ids[:roi_result_limit]
+            limited = True
+        if not cruise_ids:
+            return ([], limited)
+        query = Cruise.query().filter(Cruise.id.in_(cruise_ids))
+        return (Cruise.load_cruise_options(query).all(), limited)
+
+
+def _changed_objs(objs):
+    for obj in objs:
+        if isinstance(obj, Cruise):
+            for index in list(_track_indexes):
+                index.invalidate(obj.id)
+
+
+def _changed_obj(obj):
+    _changed_objs([obj])
+
+
+triggers.saved_obj_actions.append(_changed_obj)
+triggers.deleted_obj_actions.append(_changed_obj)
+triggers.saved_objs_actions.append(_changed_objs)
+triggers.deleted_objs_actions.append(_changed_objs)
@@ -3,6 +3,8 @@
 
 saved_obj_actions = []
 deleted_obj_actions = []
+saved_objs_actions = []
+deleted_objs_actions = []
 saved_note_actions = []
 deleted_note_actions = []
 
@@ -31,6 +33,15 @@ def deleted_obj(obj):
     _call(deleted_obj_actions, obj)
 
 
+def saved_objs(objs):
+    """Many objs were saved at once, e.g. by a bulk update."""
+    _call(saved_objs_actions, objs)
+
+
+def deleted_objs(objs):
+    _call(deleted_objs_actions, objs)
+
+
 def saved_note(note):
     _call(saved_note_actions, note)
 
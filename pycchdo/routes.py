@@ -199,6 +199,11 @@ def configure_routes(config):
                'pycchdo.views.legacy.add_extension')
     route_path(config, 'search_map_ids', '/search/map/ids',
                'pycchdo.views.search_map.ids')
+    route_path(config, 'search_map_info', '/search/map/info',
+               'pycchdo.views.search_map.info')
+    route_path(config, 'search_map_tile',
+               '/search/map/tiles/{z}/{x}/{y}.json',
+               'pycchdo.views.search_map.tile')
     route_path(config, 'search_map_layer', '/search/map/layer',
                'pycchdo.views.search_map.layer')
 
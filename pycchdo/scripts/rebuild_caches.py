@@ -0,0 +1,133 @@
+import argparse
+from logging import getLogger, WARN, INFO, DEBUG
+
+import transaction
+
+from sqlalchemy import engine_from_config, inspect
+from sqlalchemy.schema import CreateIndex
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pycchdo.models.serial import (
+    DBSession, Obj, Cruise, _ObjCurrentAttr, _CruiseDataUpdate,
+    _CruiseIdentifier, _CruiseTrack,
+    )
+
+
+log = getLogger(__name__)
+
+
+def _ensure_objs_mtime(engine):
+    """Add the objs.mtime column and its index to databases that predate it."""
+    table = Obj.__table__
+    inspector = inspect(engine)
+    columns = [col['name'] for col in
+               inspector.get_columns(table.name, schema=table.schema)]
+    if 'mtime' in columns:
+        return
+    log.info(u'Adding {0}.mtime'.format(table.fullname))
+    engine.execute(
+        'ALTER TABLE {0} ADD COLUMN mtime TIMESTAMP WITHOUT TIME ZONE'.format(
+            table.fullname))
+    for index in table.indexes:
+        if 'mtime' in index.columns:
+            engine.execute(CreateIndex(index))
+
+
+def _ensure_indexes(engine, table):
+    """Create the indexes that were added to table after it was created."""
+    inspector = inspect(engine)
+    existing = set(index['name'] for index in
+                   inspector.get_indexes(table.name, schema=table.schema))
+    for index in table.indexes:
+        if index.name not in existing:
+            log.info(u'Creating index {0}'.format(index.name))
+            index.create(engine)
+
+
+def rebuild_mtime(engine):
+    _ensure_objs_mtime(engine)
+    log.info(u'Backfilling Obj modification times')
+    Obj.backfill_mtime()
+
+
+def rebuild_current_attrs(engine):
+    _ObjCurrentAttr.__table__.create(engine, checkfirst=True)
+    log.info(u'Rebuilding Obj current attrs')
+    Obj.rebuild_current_attrs()
+
+
+def rebuild_data_updates(engine):
+    _CruiseDataUpdate.__table__.create(engine, checkfirst=True)
+    log.info(u'Rebuilding recent cruise data updates')
+    Cruise.rebuild_data_updates()
+
+
+def rebuild_identifiers(engine):
+    _CruiseIdentifier.__table__.create(engine, checkfirst=True)
+    log.info(u'Rebuilding cruise identifiers')
+    Cruise.rebuild_identifiers()
+
+
+def rebuild_tracks(engine):
+    _CruiseTrack.__table__.create(engine, checkfirst=True)
+    log.info(u'Rebuilding simplified cruise tracks')
+    Cruise.rebuild_tracks()
+
+
+def rebuild_pending_indexes(engine):
+    _ensure_objs_mtime(engine)
+    _ensure_indexes(engine, Obj.__table__)
+    _ensure_indexes(engine, Cruise.__table__)
+
+
+CACHES = [
+    ('mtime', rebuild_mtime),
+    ('current_attrs', rebuild_current_attrs),
+    ('data_updates', rebuild_data_updates),
+    ('identifiers', rebuild_identifiers),
+    ('pending_indexes', rebuild_pending_indexes),
+    ('tracks', rebuild_tracks),
+]
+
+
+argparser = argparse.ArgumentParser(
+    description='Rebuild denormalized database caches')
+argparser.add_argument(
+    '-v', '--verbose', action='count', default=0,
+    help='Verbosity by logging level.')
+argparser.add_argument(
+    'config_uri', type=str, nargs='?', default='development.ini',
+    help='(default: developement.ini)')
+argparser.add_argument(
+    'caches', type=str, nargs='*',
+    help='the caches to rebuild (default: all): {0}'.format(
+        ', '.join(x[0] for x in CACHES)))
+
+
+def main():
+    args = argparser.parse_args()
+    unknown = set(args.caches) - set(x[0] for x in CACHES)
+    if unknown:
+        argparser.error(u'unknown caches: {0}'.format(', '.join(unknown)))
+
+    setup_logging(args.config_uri)
+
+    log.setLevel(WARN)
+    if args.verbose >= 0:
+        log.setLevel(INFO)
+    if args.verbose >= 1:
+        log.setLevel(DEBUG)
+
+    settings = get_appsettings(args.config_uri + '#pycchdo')
+    engine = engine_from_config(settings)
+    DBSession.configure(bind=engine)
+
+    for name, rebuild in CACHES:
+        if args.caches and name not in args.caches:
+            continue
+        rebuild(engine)
+        transaction.commit()
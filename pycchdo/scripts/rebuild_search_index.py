@@ -19,6 +19,10 @@ argparser.add_argument(
 argparser.add_argument(
     '--clear', action='store_true', default=False,
     help='Whether to clear the indexes first')
+argparser.add_argument(
+    '--procs', type=int, default=1,
+    help='Processes to build docs with; 0 for all cores. With more than one, '
+         'the indexes are rebuilt at the same time. (default: 1)')
 argparser.add_argument(
     'config_uri', type=str, nargs='?', default='development.ini',
     help='(default: developement.ini)')
@@ -45,8 +49,5 @@ def main():
     engine = engine_from_config(settings)
     DBSession.configure(bind=engine)
     si = SearchIndex(settings['search_index_path'])
-    if args.indices:
-        for index in args.indices:
-            si._rebuild_index(index, clear=args.clear)
-    else:
-        si.rebuild_index(clear=args.clear)
+    si.rebuild_index(
+        clear=args.clear, procs=args.procs or None, names=args.indices)
@@ -0,0 +1,75 @@
+import argparse
+from time import sleep
+from logging import getLogger, WARN, INFO, DEBUG
+
+import transaction
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pycchdo.models.serial import DBSession
+from pycchdo.models.search import SearchIndex, _IndexJob, DETAIL
+
+
+argparser = argparse.ArgumentParser(
+    description='Apply queued search index updates')
+argparser.add_argument(
+    '-v', '--verbose', action='count', default=0,
+    help='Verbosity by logging level.')
+argparser.add_argument(
+    '--poll', type=float, default=5,
+    help='Seconds to wait when the queue is empty (default: 5)')
+argparser.add_argument(
+    '--batch-size', type=int, default=500,
+    help='Maximum number of jobs applied at once (default: 500)')
+argparser.add_argument(
+    '--once', action='store_true', default=False,
+    help='Exit once the queue is empty')
+argparser.add_argument(
+    'config_uri', type=str, nargs='?', default='development.ini',
+    help='(default: developement.ini)')
+
+
+def main():
+    args = argparser.parse_args()
+
+    setup_logging(args.config_uri)
+
+    logger = getLogger('pycchdo.models.search')
+    logger.setLevel(WARN)
+    if args.verbose >= 0:
+        logger.setLevel(INFO)
+    if args.verbose >= 1:
+        logger.setLevel(DEBUG)
+    if args.verbose >= 2:
+        logger.setLevel(DETAIL)
+
+    settings = get_appsettings(args.config_uri + '#pycchdo')
+    engine = engine_from_config(settings)
+    DBSession.configure(bind=engine)
+    _IndexJob.__table__.create(engine, checkfirst=True)
+
+    si = SearchIndex(settings['search_index_path'])
+    # The indexer only applies the queue.
+    si.unregister_triggers()
+
+    writers = {}
+    try:
+        while True:
+            try:
+                applied = si.apply_jobs(writers, args.batch_size)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                raise
+            if not applied:
+                if args.once:
+                    break
+                sleep(args.poll)
+    finally:
+        for ixw in writers.values():
+            ixw.close()
@@ -926,7 +926,8 @@ Model.prototype.query = function (layer, query, callback, tracks_callback,
       var tracks = [];
       for (var tid in ts) {
         if (self._t[tid] === undefined) {
-          var track = new Track(tid, ts[tid], {map: self._map});
+          var track = new Track(tid, decodePolyline(ts[tid]),
+                                {map: self._map});
           track._model = self;
           self._t[tid] = track;
           tracks.push(track);
@@ -950,6 +951,7 @@ Model.prototype.query = function (layer, query, callback, tracks_callback,
   }
   queryData.time_min = query.time_min || CM.TIME_MIN;
   queryData.time_max = query.time_max || CM.TIME_MAX;
+  queryData.track_format = 'polyline';
 
   $.ajax({
     url: CM.APPNAME + '/ids',
@@ -1121,9 +1123,33 @@ function GVTable(dom, splitter) {
   $(this._table_dom).delegate('button[infodata-id]', 'click', function(event) {
     var button = $(this);
     var iid = button.attr('infodata-id');
-    $('#' + iid).dialog({
-      width: 350,
-      position: {my: 'right', at: 'left', of: button},
+    var datadiv = $('#' + iid);
+
+    function showDialog() {
+      datadiv.dialog({
+        width: 350,
+        position: {my: 'right', at: 'left', of: button},
+      });
+    }
+
+    // Data listings are only loaded once they are asked for.
+    var cid = datadiv.attr('cruise-id');
+    if (cid === undefined) {
+      showDialog();
+      return false;
+    }
+    $.ajax({
+      url: CM.APPNAME + '/info',
+      method: 'GET',
+      dataType: 'json',
+      data: {ids: cid},
+      success: function (infos) {
+        datadiv.removeAttr('cruise-id').html(infos[cid].data);
+        showDialog();
+      },
+      error: function () {
+        CM.tip(CM.TIPS['searcherror']);
+      }
     });
     return false;
   });
@@ -1293,12 +1319,17 @@ GVTable.prototype.get_trid = function (tr) {
 GVTable.prototype.add = function (id, info, hasTrack) {
   var dataid = info.name;
   var infodataid = 'infodata' + id;
-  var datadiv = $('<div>' + info.data + '</div>').
+  var datadiv = $('<div></div>').
     addClass('data-formats').
     css('position', 'relative').
     attr('title', info.name).
     attr('id', infodataid).
     appendTo(this.dcart_dialogs());
+  if (info.data === undefined) {
+    datadiv.attr('cruise-id', id);
+  } else {
+    datadiv.html(info.data);
+  }
   var databutton = '<button class="datacart-blank" infodata-id="' + infodataid +
     '" title="Add/remove data"><div class="datacart-icon"></div></button>';
   var data_row = this._dt.addRow([
@@ -1414,6 +1445,35 @@ GVTable.prototype.redraw = function () {
 };
 
 
+// Decode a Google encoded polyline into a list of [lng, lat].
+function decodePolyline(encoded, precision) {
+  var factor = Math.pow(10, precision || 5);
+  var coords = [];
+  var index = 0;
+  var lat = 0;
+  var lng = 0;
+
+  function nextDelta() {
+    var result = 0;
+    var shift = 0;
+    var b;
+    do {
+      b = encoded.charCodeAt(index) - 63;
+      index += 1;
+      result |= (b & 0x1f) << shift;
+      shift += 5;
+    } while (b >= 0x20);
+    return (result & 1) ? ~(result >> 1) : (result >> 1);
+  }
+
+  while (index < encoded.length) {
+    lat += nextDelta();
+    lng += nextDelta();
+    coords.push([lng / factor, lat / factor]);
+  }
+  return coords;
+}
+
 function Track(id, coords, opts) {
   this.id = id;
   this.setValues(opts);
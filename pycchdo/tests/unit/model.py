@@ -1,12 +1,21 @@
-from datetime import datetime
+import json
+import os.path
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
+from shutil import rmtree
 
 from pyramid import testing
 
 from pycchdo.log import getLogger
-from pycchdo.tests import BaseTest, PersonBaseTest, RequestBaseTest
-from pycchdo.models.serial import SerializerDateTime, Unit, Cruise, Ship
+from pycchdo.tests import (
+    BaseTest, PersonBaseTest, RequestBaseTest, MockFile, MockFieldStorage)
+from pycchdo.models.serial import (
+    DBSession, SerializerDateTime, Change, Unit, Cruise, Ship, Collection)
 from whoosh import writing
 from pycchdo.models.searchsort import CruiseSorter
+from pycchdo.models.tracks import PackedTracks, TrackIndex, split_at_dateline
+from pycchdo.models.tiles import TrackTiles, tile_bounds, tile_ranges
+from shapely.geometry import box
 
 
 log = getLogger(__name__)
@@ -107,6 +116,118 @@ class TestSearchIndex(RequestBaseTest):
         sss = Ship.create(self.testPerson).obj
         sidx.save_obj(sss)
 
+    def test_queue_coalesces(self):
+        sidx = self.request.registry.settings['db.search_index']
+        ccc = Cruise.create(self.testPerson).obj
+        DBSession.flush()
+        sidx.queue_save_obj(ccc)
+        sidx.queue_save_obj(ccc)
+        sidx.queue_remove_obj(ccc)
+        updates = DBSession().info['search_index_updates'][sidx]
+        self.assertEqual({'remove': [ccc.id]}, updates.by_index()['cruise'])
+
+    def test_index_updates_listen(self):
+        from sqlalchemy import event
+        from pycchdo.models.serial import Session
+        from pycchdo.models.search import (
+            _build_index_docs, _apply_index_updates, _discard_index_updates)
+        self.assertTrue(
+            event.contains(Session, 'before_commit', _build_index_docs))
+        self.assertTrue(
+            event.contains(Session, 'after_commit', _apply_index_updates))
+        self.assertTrue(
+            event.contains(Session, 'after_rollback', _discard_index_updates))
+
+    def test_queued_save_written(self):
+        from pycchdo.models.search import (
+            _build_index_docs, _apply_index_updates, _model_id_to_index_id)
+        sidx = self.request.registry.settings['db.search_index']
+        ccc = Cruise.create(self.testPerson).obj
+        sidx.queue_save_obj(ccc)
+        session = DBSession()
+        _build_index_docs(session)
+        docs = session.info['search_index_updates'][sidx].docs['cruise']
+        self.assertEqual(
+            [_model_id_to_index_id(ccc.id)],
+            [doc['id'] for id, doc in docs if id == ccc.id])
+
+        _apply_index_updates(session)
+        self.assertNotIn('search_index_updates', session.info)
+        with sidx.searcher('cruise') as searcher:
+            self.assertIsNotNone(
+                searcher.document(id=_model_id_to_index_id(ccc.id)))
+
+    def test_rollback_discards_updates(self):
+        from pycchdo.models.search import (
+            _build_index_docs, _apply_index_updates, _discard_index_updates,
+            _model_id_to_index_id)
+        sidx = self.request.registry.settings['db.search_index']
+        ccc = Cruise.create(self.testPerson).obj
+        sidx.queue_save_obj(ccc)
+        session = DBSession()
+        _build_index_docs(session)
+        _discard_index_updates(session)
+        self.assertNotIn('search_index_updates', session.info)
+
+        _apply_index_updates(session)
+        with sidx.searcher('cruise') as searcher:
+            self.assertIsNone(
+                searcher.document(id=_model_id_to_index_id(ccc.id)))
+
+    def test_enqueue(self):
+        from pycchdo.models.search import SearchIndex, IndexUpdates, _IndexJob
+        sidx = SearchIndex(
+            self.request.registry.settings['search_index_path'], queue=True)
+        sidx.unregister_triggers()
+        updates = IndexUpdates()
+        updates.add('cruise', 1, IndexUpdates.SAVE)
+        updates.add('cruise', 1, IndexUpdates.REMOVE)
+        sidx._enqueue(DBSession(), updates)
+        self.assertEqual(
+            [('cruise', 1, IndexUpdates.REMOVE)],
+            DBSession.query(
+                _IndexJob.index_name, _IndexJob.doc_id, _IndexJob.op).all())
+
+    def test_build_chunk_docs(self):
+        from pycchdo.models.search import _build_chunk_docs
+        sidx = self.request.registry.settings['db.search_index']
+        sss = Ship.create(self.testPerson).obj
+        DBSession.flush()
+        name, docs = _build_chunk_docs(sidx, 'ship', [sss.id, -1])
+        self.assertEqual('ship', name)
+        self.assertEqual([sss.id, -1], [id for id, doc in docs])
+        self.assertIsNone(docs[1][1])
+
+    def test_clean_index(self):
+        sidx = self.request.registry.settings['db.search_index']
+        sss = Ship.create(self.testPerson).obj
+        DBSession.flush()
+        sidx.save_obj(sss)
+        with sidx.writer('ship') as ixw:
+            ixw.update_document(id=u'-5', name=u'gone', mtime=datetime.now())
+
+        indexed_ids = set()
+        to_index = set()
+        with sidx.writer('ship') as ixw:
+            sidx._clean_index(ixw, Ship, indexed_ids, to_index)
+        self.assertIn(sss.id, indexed_ids)
+        self.assertNotIn(sss.id, to_index)
+        with sidx.searcher('ship') as searcher:
+            self.assertIsNone(searcher.document(id=u'-5'))
+
+    def test_pooled_searcher(self):
+        sidx = self.request.registry.settings['db.search_index']
+        with sidx.searcher('country') as searcher:
+            pass
+        with sidx.searcher('country') as same:
+            self.assertIs(searcher, same)
+        with sidx.writer('country') as ixw:
+            ixw.update_document(
+                names=u'pooled', mtime=datetime.now(), id=u'-7')
+        with sidx.searcher('country') as refreshed:
+            self.assertIsNot(searcher, refreshed)
+            self.assertIsNotNone(refreshed.document(id=u'-7'))
+
     def test_writer_finally_commit(self):
         sidx = self.request.registry.settings['db.search_index']
         with sidx.writer('country') as ixw:
@@ -166,9 +287,354 @@ class TestObj(PersonBaseTest):
         changes = obj.get_attrs_or(['name', 'mnemonic'])
         self.assertEqual([bbb, ddd], changes)
 
+    def test_iter_changes(self):
+        obj = Unit.create(self.testPerson).obj
+        changes = [obj.sugg(self.testPerson, 'name', str(i)) for i in range(5)]
+        DBSession.flush()
+        changes.reverse()
+
+        self.assertEqual(
+            changes, list(obj.iter_changes('unjudged', batch_size=2)))
+        self.assertEqual(
+            changes[2:], list(obj.iter_changes(after=changes[1].id)))
+        self.assertEqual([], list(obj.iter_changes(data=True)))
+
+    def test_current_attrs(self):
+        obj = Unit.create(self.testPerson).obj
+        aaa = obj.set(self.testPerson, 'name', 'aaa')
+        bbb = obj.set(self.testPerson, 'name', 'bbb')
+        DBSession.flush()
+        self.assertEqual([obj], Unit.get_all_by_attrs(name='bbb'))
+        self.assertEqual([], Unit.get_all_by_attrs(name='aaa'))
+
+        bbb.reject(self.testPerson)
+        self.assertEqual(aaa, obj.get_attr('name'))
+        aaa.reject(self.testPerson)
+        with self.assertRaises(KeyError):
+            obj.get_attr('name')
+
+        aaa.accept(self.testPerson)
+        DBSession.flush()
+        Unit.rebuild_current_attrs()
+        DBSession.expire(obj)
+        self.assertEqual(aaa, obj.get_attr('name'))
+
+    def test_prefetch_attrs(self):
+        obj = Unit.create(self.testPerson).obj
+        obj.set(self.testPerson, 'name', 'aaa')
+        bbb = obj.set(self.testPerson, 'name', 'bbb')
+        other = Unit.create(self.testPerson).obj
+
+        Unit.prefetch_attrs([obj, other], ['name', 'mnemonic'])
+        self.assertEqual(bbb, obj.get_attr('name'))
+        self.assertEqual([bbb], obj.get_attrs_or(['name', 'mnemonic']))
+        with self.assertRaises(KeyError):
+            other.get_attr('name')
+
+        ccc = obj.set(self.testPerson, 'name', 'ccc')
+        self.assertEqual(ccc, obj.get_attr('name'))
+
+    def test_mtime(self):
+        obj = Unit.create(self.testPerson).obj
+        aaa = obj.sugg(self.testPerson, 'name', 'aaa')
+        aaa.accept(self.testPerson)
+        self.assertEqual(aaa.ts_j, obj.mtime)
+
+        aaa.ts_j = datetime(2000, 1, 1)
+        DBSession.flush()
+        Unit.backfill_mtime()
+        DBSession.refresh(obj)
+        self.assertEqual(obj.change.ts_j, obj.mtime)
+        self.assertIn(obj, Unit.recently_modified())
+
+
+class TestChange(PersonBaseTest):
+    def test_value_memo(self):
+        obj = Unit.create(self.testPerson).obj
+        change = obj.set(self.testPerson, 'name', 'aaa')
+        self.assertEqual('aaa', change.value)
+        self.assertEqual('aaa', change.value)
+
+        change._set_value('bbb')
+        self.assertEqual('bbb', change.value)
+        change.value_accepted = 'ccc'
+        self.assertEqual('ccc', change.value)
+        self.assertEqual('bbb', change.value_original)
+
+    def test_resolve_values(self):
+        ship = Ship.create(self.testPerson).obj
+        cruise = Cruise.create(self.testPerson).obj
+        change = cruise.set(self.testPerson, 'ship', ship)
+        change._forget_deserialized()
+        doc = cruise.set(self.testPerson, 'doc_txt', MockFieldStorage(
+            MockFile('doc', 'doc.txt')))
+        DBSession.flush()
+        doc._forget_deserialized()
+
+        Change.resolve_values([change, doc])
+        self.assertEqual(ship, change._deserialized[(change.id, change._value)])
+        self.assertEqual(ship, change.value)
+        self.assertEqual(
+            json.loads(doc._value)['val'],
+            doc._deserialized[(doc.id, doc._value)].id)
+
 
 class TestCruise(PersonBaseTest):
+    def test_prefetch_file_attrs(self):
+        aaa = Cruise.create(self.testPerson).obj
+        bbb = Cruise.create(self.testPerson).obj
+        doc0 = aaa.set(self.testPerson, 'doc_txt', MockFieldStorage(
+            MockFile('doc0', 'doc0.txt')))
+        doc1 = aaa.set(self.testPerson, 'doc_txt', MockFieldStorage(
+            MockFile('doc1', 'doc1.txt')))
+        DBSession.flush()
+
+        Cruise.prefetch_file_attrs([aaa, bbb])
+        self.assertEqual({'doc_txt': doc1}, aaa.file_attrs)
+        self.assertNotIn(doc0, aaa.file_attrs.values())
+        self.assertEqual({}, bbb.file_attrs)
+
+    def test_updated(self):
+        aaa = Cruise.create(self.testPerson).obj
+        bbb = Cruise.create(self.testPerson).obj
+        doc0 = aaa.set(self.testPerson, 'doc_txt', MockFieldStorage(
+            MockFile('doc0', 'doc0.txt')))
+        doc1 = bbb.set(self.testPerson, 'doc_txt', MockFieldStorage(
+            MockFile('doc1', 'doc1.txt')))
+        doc2 = aaa.set(self.testPerson, 'doc_pdf', MockFieldStorage(
+            MockFile('doc2', 'doc2.pdf')))
+        DBSession.flush()
+        self.assertEqual([doc2, doc1], Cruise.updated(2))
+
+        doc2.reject(self.testPerson)
+        DBSession.flush()
+        self.assertEqual([doc1, doc0], Cruise.updated(2))
+
+    def test_attr_schemas(self):
+        schemas = Cruise._attr_schemas()
+        self.assertTrue(schemas['bottle_exchange'].is_file)
+        self.assertTrue(schemas['bottle_exchange_status'].is_status)
+        self.assertEqual(Ship, schemas['ship'].model)
+        self.assertIn('import_id', schemas)
+        with self.assertRaises(TypeError):
+            schemas['ship'] = None
+        with self.assertRaises(ValueError):
+            Cruise.attr_type('no such attr')
+
     def test_get_by_id(self):
         ccc = Cruise.create(self.testPerson).obj
         with self.assertRaises(ValueError):
             Cruise.get_by_id('no such id')
+
+    def test_resolve_identifiers_by_attrs(self):
+        aaa = Cruise.create(self.testPerson).obj
+        aaa.set(self.testPerson, 'expocode', 'AAA')
+        DBSession.flush()
+        self.assertEqual(
+            {u'AAA': aaa.id, unicode(aaa.id): aaa.id},
+            Cruise._resolve_identifiers_by_attrs(
+                [u'AAA', unicode(aaa.id), u'no such id']))
+
+    def test_get_by_ids(self):
+        aaa = Cruise.create(self.testPerson).obj
+        bbb = Cruise.create(self.testPerson).obj
+        aaa.set(self.testPerson, 'expocode', 'AAA')
+        bbb.set(self.testPerson, 'aliases', ['BBB'])
+        DBSession.flush()
+
+        self.assertEqual(
+            [bbb, aaa, aaa], Cruise.get_by_ids([bbb.id, 'AAA', str(aaa.id)]))
+        self.assertEqual(bbb, Cruise.get_by_id('BBB'))
+        with self.assertRaises(ValueError):
+            Cruise.get_by_ids(['AAA', 'no such id'])
+
+        aaa.set(self.testPerson, 'expocode', 'CCC')
+        DBSession.flush()
+        self.assertEqual(aaa, Cruise.get_by_id('CCC'))
+        with self.assertRaises(ValueError):
+            Cruise.get_by_id('AAA')
+
+    def test_pending(self):
+        next_year = datetime.now().year + 1
+        aaa = Cruise.propose(self.testPerson).obj
+        aaa.set(self.testPerson, 'date_start', datetime(next_year + 1, 1, 1))
+        bbb = Cruise.propose(self.testPerson).obj
+        bbb.set(self.testPerson, 'date_start', datetime(next_year, 1, 1))
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'date_start', datetime(next_year + 2, 1, 1))
+        DBSession.flush()
+
+        self.assertEqual([bbb, aaa], Cruise.upcoming(2))
+        self.assertEqual([bbb], Cruise.upcoming(1))
+        self.assertEqual([next_year, next_year + 1], Cruise.pending_years())
+
+        bbb.set(self.testPerson, 'date_start', datetime(next_year + 1, 1, 2))
+        DBSession.flush()
+        self.assertEqual([aaa, bbb], Cruise.upcoming(2))
+        self.assertEqual([next_year + 1], Cruise.pending_years())
+
+    def test_reduce_specifics(self):
+        next_year = datetime.now().year + 1
+        usa = Cruise.create(self.testPerson).obj
+        usa.set(self.testPerson, 'expocode', '33RR{0}0101'.format(next_year))
+        usa.set(self.testPerson, 'date_start', datetime(next_year, 3, 4))
+        other = Cruise.create(self.testPerson).obj
+        other.set(self.testPerson, 'expocode', '74JC{0}0101'.format(next_year))
+        other.set(self.testPerson, 'date_start', datetime(next_year, 3, 4))
+        DBSession.flush()
+
+        Cruise.reduce_specifics([usa, other])
+        self.assertEqual(datetime(next_year, 1, 1), usa.date_start)
+        self.assertEqual(datetime(next_year, 3, 4), other.date_start)
+        self.assertNotIn(usa, DBSession.dirty)
+
+        DBSession.expire_all()
+        cruises = Cruise.all_reduced_specifics(
+            Cruise.query().filter(Cruise.id.in_([usa.id, other.id])))
+        self.assertEqual(2, len(cruises))
+        self.assertEqual(datetime(next_year, 1, 1), usa.date_start)
+        self.assertEqual(datetime(next_year, 3, 4), other.date_start)
+
+    def test_simplified_tracks(self):
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track',
+                [[0, 0], [0, 0], [1, 1], [2, 2.001], [3, 3]])
+        DBSession.flush()
+
+        self.assertEqual(
+            {ccc.id: [[0, 0], [1, 1], [2, 2.001], [3, 3]]},
+            Cruise.simplified_tracks([ccc.id], max_coords=50))
+        self.assertEqual(
+            {ccc.id: [[0, 0], [3, 3]]},
+            Cruise.simplified_tracks([ccc.id], max_coords=2))
+        self.assertEqual(
+            {ccc.id: [[0, 0], [3, 3]]},
+            Cruise.simplified_tracks([ccc.id], zoom=0))
+
+
+class TestObjMerger(PersonBaseTest):
+    def test_dry_run(self):
+        ss0 = Ship.create(self.testPerson).obj
+        ss1 = Ship.create(self.testPerson).obj
+        cr0 = Cruise.create(self.testPerson).obj
+        cr0.set(self.testPerson, 'ship', ss1)
+
+        counts = ss0.merge(self.testPerson, ss1, dry_run=True)
+        self.assertEqual(1, counts['changes'])
+        self.assertEqual(1, counts['Cruise.ship'])
+        self.assertEqual(ss1, cr0.ship)
+
+        counts = ss0.merge(self.testPerson, ss1)
+        self.assertEqual(1, counts['changes'])
+        self.assertEqual(ss0, cr0.ship)
+        self.assertEqual(ss0, cr0.get('ship'))
+        self.assertEqual(None, Ship.query().get(ss1.id))
+
+    def test_accepted_replacement(self):
+        cc0 = Collection.create(self.testPerson).obj
+        cc1 = Collection.create(self.testPerson).obj
+        cc2 = Collection.create(self.testPerson).obj
+        cc3 = Collection.create(self.testPerson).obj
+        cr0 = Cruise.create(self.testPerson).obj
+        change = cr0.sugg(self.testPerson, 'collections', [cc1])
+        change.accept(self.testPerson, [cc2, cc3])
+        DBSession.flush()
+
+        cc0.merge(self.testPerson, cc1, cc2)
+        self.assertEqual([cc0, cc3], cr0.get('collections'))
+
+
+class TestPackedTracks(BaseTest):
+    def test_filters(self):
+        tracks = PackedTracks([
+            [[170, 0], [179, 1]],
+            [],
+            [[-10, -10], [10, 10]],
+            ])
+        self.assertEqual(
+            [True, False, False],
+            list(tracks.in_rectangle((175, -5), (-170, 5))))
+        self.assertEqual(
+            [False, False, True],
+            list(tracks.in_polygon([[-1, -1], [1, -1], [1, 1], [-1, 1]])))
+
+
+class TestTrackIndex(PersonBaseTest):
+    def test_cruise_ids_in(self):
+        self.assertEqual(
+            2, len(split_at_dateline([[179, 0], [-179, 0], [-178, 1]]).geoms))
+
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track', [[0, 0], [1, 1]])
+        DBSession.flush()
+
+        index = TrackIndex()
+        self.assertIn(ccc.id, index.cruise_ids_in(box(-1, -1, 2, 2)))
+        self.assertNotIn(ccc.id, index.cruise_ids_in(box(5, 5, 6, 6)))
+
+        ccc.set(self.testPerson, 'track', [[5, 5], [6, 6]])
+        DBSession.flush()
+        self.assertIn(ccc.id, index.cruise_ids_in(box(5, 5, 6, 6)))
+
+    def test_refresh_late_commit(self):
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track', [[0, 0], [1, 1]])
+        DBSession.flush()
+        index = TrackIndex()
+        index.cruise_ids_in(box(-1, -1, 2, 2))
+
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track', [[0, 0], [1, 1]])
+        # Changed before the last refresh but committed after it
+        ccc._mtime = index._mtime - timedelta(minutes=1)
+        DBSession.flush()
+        index._dirty_ids.clear()
+        self.assertIn(ccc.id, index.cruise_ids_in(box(-1, -1, 2, 2)))
+
+
+class TestTrackTiles(PersonBaseTest):
+    def test_build(self):
+        west, south, east, north = tile_bounds(1, 1, 0)
+        self.assertEqual((0, 180), (west, east))
+        self.assertAlmostEqual(0, south)
+        x_range, y_range = tile_ranges((10, 10, 20, 20), 1)
+        self.assertEqual(([1], [0]), (list(x_range), list(y_range)))
+
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track', [[10, 10], [20, 20]])
+        DBSession.flush()
+
+        tiles = TrackTiles(TrackIndex())
+        ids = [feature['properties']['id'] for feature in
+               json.loads(tiles.build(1, 1, 0))['features']]
+        self.assertIn(ccc.id, ids)
+        ids = [feature['properties']['id'] for feature in
+               json.loads(tiles.build(1, 0, 0))['features']]
+        self.assertNotIn(ccc.id, ids)
+
+    def test_get(self):
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.set(self.testPerson, 'track', [[10, 10], [20, 20]])
+        DBSession.flush()
+        DBSession().info.pop('changed_track_geoms', None)
+
+        ccc.set(self.testPerson, 'expocode', 'EXPO')
+        DBSession.flush()
+        self.assertEqual(1, len(DBSession().info['changed_track_geoms']))
+
+        tempdir = mkdtemp()
+        try:
+            tiles = TrackTiles(TrackIndex(), tempdir)
+            path = tiles._tile_path(1, 1, 0)
+            self.assertEqual(tiles.get(1, 1, 0), tiles.get(1, 1, 0))
+            self.assertTrue(os.path.exists(path))
+
+            tiles.invalidate([box(10, 10, 20, 20)])
+            self.assertEqual(1, tiles.generation())
+            self.assertFalse(os.path.exists(path))
+
+            # Built before the last invalidation
+            tiles._write(path, tiles.build(1, 1, 0), 0)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            rmtree(tempdir)
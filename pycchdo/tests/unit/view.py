@@ -167,6 +167,27 @@ class TestCruise(RequestBaseTest):
         _add_note(self.request, ccc)
 
 
+class TestObj(RequestBaseTest):
+    def test_obj_notes(self):
+        from pycchdo.views.obj import obj_notes
+
+        ccc = Cruise.create(self.testPerson).obj
+        ccc.change._notes.append(Note(self.testPerson, 'aaa'))
+        ccc.change._notes.append(Note(self.testPerson, 'bbb'))
+        DBSession.flush()
+
+        self.request.matchdict['obj_id'] = ccc.id
+        self.assertEqual(2, len(obj_notes(self.request)))
+
+        self.request.params['items_per_page'] = 1
+        page = obj_notes(self.request)
+        self.assertEqual(1, len(page['notes']))
+        self.request.params['after'] = page['after']
+        page = obj_notes(self.request)
+        self.assertEqual(1, len(page['notes']))
+        self.assertIsNone(page['after'])
+
+
 class TestCountry(RequestBaseTest):
     def test_index(self):
         from pycchdo.views.country import countries_index, countries_index_json
@@ -195,6 +216,40 @@ class TestCollection(RequestBaseTest):
         collections_index_json(self.request)
 
 
+class TestSearchMap(RequestBaseTest):
+    def test_ids_labels_only(self):
+        from pycchdo.views.search_map import ids, info
+
+        ccc = Cruise.create(self.testPerson).obj
+        DBSession.flush()
+
+        self.request.params['ids'] = str(ccc.id)
+        response = json.loads(ids(self.request).body)
+        self.assertNotIn('data', response['i'][str(ccc.id)])
+
+        self.request.params = {}
+        with self.assertRaises(HTTPBadRequest):
+            info(self.request)
+
+    def test_encode_polyline(self):
+        from pycchdo.views.search_map import encode_polyline
+
+        self.assertEqual(
+            '_p~iF~ps|U_ulLnnqC_mqNvxq`@',
+            encode_polyline(
+                [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]))
+
+    def test_selections_cached(self):
+        from pycchdo.views.search_map import _selections
+
+        selections = _selections(['rectangle:170,-5_170,5_-170,5_-170,-5'])
+        self.assertEqual(2, len(selections))
+        self.assertIs(selections, _selections(
+            ['rectangle:170.0,-5_170,5.0_-170,5_-170,-5']))
+        with self.assertRaises(ValueError):
+            _selections(['rectangle:a,b'])
+
+
 class TestDatacart(RequestBaseTest):
     def setUp(self):
         super(TestDatacart, self).setUp()
@@ -1,4 +1,7 @@
 from datetime import datetime
+from time import time
+from collections import OrderedDict
+from threading import Lock
 import socket
 import mimetypes
 from logging import getLogger
@@ -111,6 +114,54 @@ def is_valid_ip(ip):
     return is_valid_ipv4(ip) or is_valid_ipv6(ip)
 
 
+class LRUCache(object):
+    """A small thread-safe least recently used cache.
+
+    Each worker process keeps its own instances; invalidate() them when the
+    underlying data changes.
+
+    ttl - if given, the number of seconds an entry stays valid
+
+    """
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._entries.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time() - stored > self.ttl:
+                return default
+            self._entries[key] = (value, stored)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    __setitem__ = set
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def invalidate(self, key=None):
+        """Forget key or, if no key is given, everything."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
 class MemFile(pyStringIO):
     def __init__(self, content, filename):
         pyStringIO.__init__(self, content)
@@ -1,5 +1,6 @@
 from datetime import datetime
 from cgi import FieldStorage
+from itertools import islice
 import os.path
 
 import transaction
@@ -34,7 +35,8 @@ __CONSTANTS__ = [
 
 __all__ = [
     'log',
-    'collapse_dict', 'http_method', 'paged', 'text_to_obj', 'str_to_track',
+    'collapse_dict', 'http_method', 'paged', 'keyset_paged', 'text_to_obj',
+    'str_to_track',
     'fsstore_path', 'file_response', ] + __CONSTANTS__
 
 
@@ -84,6 +86,33 @@ def paged(request, l, default_current_page=1, default_items_per_page=30):
         l, current_page, items_per_page=items_per_page, url=page_url)
 
 
+def keyset_paged(request, iterate, name='', default_items_per_page=30):
+    """Take a page of items from an iterator that continues after an id.
+
+    iterate - a callable that takes the id of the item to continue after and
+        returns an iterator of items e.g. Obj.iter_changes
+    name - prefix for the request parameter holding the id to continue after
+
+    Returns: a tuple of the page of items and the id to continue after for the
+    next page or None if there are no more.
+
+    """
+    try:
+        after = int(request.params['{0}after'.format(name)])
+    except (KeyError, ValueError):
+        after = None
+    try:
+        items_per_page = int(request.params.get('items_per_page',
+                                                default_items_per_page))
+    except ValueError:
+        items_per_page = default_items_per_page
+    items = list(islice(iterate(after), items_per_page + 1))
+    if len(items) > items_per_page:
+        items = items[:items_per_page]
+        return (items, items[-1].id)
+    return (items, None)
+
+
 def _unescape(s, escape='\\'):
     n = s.find(escape)
     while n > -1:
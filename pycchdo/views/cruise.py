@@ -65,7 +65,7 @@ def cruise_attrs_select():
         Cruise, _DISALLOWED_CRUISE_ATTR_TYPES, _DISALLOWED_CRUISE_ATTR_KEYS)
 
 
-def _cruises(request, subtypes=None, defer_load=False):
+def _cruises(request, subtypes=None):
     seahunt = request.params.get('seahunt_only', False)
     allow_seahunt = request.params.get('allow_seahunt', False)
     if seahunt:
@@ -75,16 +75,12 @@ def _cruises(request, subtypes=None, defer_load=False):
     else:
         query = Cruise.query().filter(Cruise.accepted == True)
 
-    cruises = query.all()
-    cruises = sorted(cruises, key=lambda c: c.uid)
-    if not defer_load:
-        h.reduce_specificity(request, *cruises)
-    return cruises
+    cruises = h.all_reduced_specificity(request, query)
+    return sorted(cruises, key=lambda c: c.uid)
 
 
 def cruises_index(request):
-    cruises = paged(request, _cruises(request, defer_load=True))
-    h.reduce_specificity(request, *cruises)
+    cruises = paged(request, _cruises(request))
     return {'cruises': cruises}
 
 
@@ -97,14 +93,14 @@ def cruises_index_json(request):
             cruise = Cruise.get_by_id(id)
         except ValueError:
             raise HTTPBadRequest()
-        return _cruise_to_json(cruise)
+        return _cruises_to_json([cruise])[0]
     elif request.params.get('ids'):
         ids = [x.strip() for x in request.params.get('ids').split(',')]
         try:
-            cruises = [Cruise.get_by_id(cruise_id) for cruise_id in ids]
+            cruises = Cruise.get_by_ids(ids)
         except ValueError:
             raise HTTPBadRequest()
-        return [_cruise_to_json(cruise) for cruise in cruises]
+        return _cruises_to_json(cruises)
     elif request.params.get('contributions'):
         return _contributions(request)
     elif request.params.get('contribution_kmzs'):
@@ -491,6 +487,7 @@ def cruise_show(request):
             _add_note_to_file(request)
 
     history = []
+    updates_after = {}
     if cruise_obj:
         h.reduce_specificity(request, cruise_obj)
         if request.user:
@@ -504,18 +501,26 @@ def cruise_show(request):
         else:
             sugg_state = 'pending'
 
-        orderer = lambda change: change.order_by(Change.ts_c.desc())
         # Only non-data suggestions
-        unjudged = cruise_obj.changes(
-            sugg_state, data=False, query_modifier=orderer)
-        suggested_attrs = [
-            change for change in unjudged \
-            if change.attr in Cruise.allowed_attrs_list]
-
-        as_received = cruise_obj.changes(
-            sugg_state, data=True, query_modifier=orderer)
-        merged = cruise_obj.changes(
-            'accepted', data=True, query_modifier=orderer)
+        def iter_suggested_attrs(after):
+            return (
+                change for change in cruise_obj.iter_changes(
+                    sugg_state, data=False, after=after) \
+                if change.attr in Cruise.allowed_attrs_list)
+
+        suggested_attrs, updates_after['attrs'] = keyset_paged(
+            request, iter_suggested_attrs, 'attrs_')
+        as_received, updates_after['as_received'] = keyset_paged(
+            request,
+            lambda after: cruise_obj.iter_changes(
+                sugg_state, data=True, after=after),
+            'as_received_')
+        merged, updates_after['merged'] = keyset_paged(
+            request,
+            lambda after: cruise_obj.iter_changes(
+                'accepted', data=True, after=after),
+            'merged_')
+        Change.resolve_values(suggested_attrs + as_received + merged)
         updates = {
             'attrs': suggested_attrs,
             'as_received': as_received,
@@ -527,6 +532,7 @@ def cruise_show(request):
         'data_files': h.collect_data_files(cruise_obj),
         'history': history,
         'updates': collapse_dict(updates, []) or {},
+        'updates_after': updates_after,
         'CRUISE_ATTRS_SELECT': cruise_attrs_select(),
         'FILE_GROUPS_SELECT': FILE_GROUPS_SELECT,
         }
@@ -601,7 +607,7 @@ def _cruise_to_json(cruise):
         'id': str(cruise.id),
         'obj_url': h.path_cruise(cruise), 
     }
-    for attr_key, value in cruise._allowed_attrs_dict().items():
+    for attr_key in cruise._attr_schemas():
         v = cruise.get(attr_key)
         if v:
             if isinstance(v, FSFile):
@@ -620,6 +626,13 @@ def _cruise_to_json(cruise):
     return obj
 
 
+def _cruises_to_json(cruises):
+    """Convert many cruises to JSON while loading their attrs in bulk."""
+    if cruises:
+        Cruise.prefetch_attrs(cruises, cruises[0]._attr_schemas().keys())
+    return [_cruise_to_json(cruise) for cruise in cruises]
+
+
 def kml(request):
     try:
         cruise_id = request.matchdict['cruise_id']
@@ -153,6 +153,7 @@ def add_cruises(request):
     except KeyError:
         raise HTTPNotFound()
     log.debug(cruise_ids)
+    _prefetch_cruises(cruise_ids)
 
     file_count_all = 0
     count_diff_all = 0
@@ -185,6 +186,7 @@ def remove_cruises(request):
         cruise_ids = request.params.getall('ids')
     except KeyError:
         raise HTTPNotFound()
+    _prefetch_cruises(cruise_ids)
 
     file_count_all = 0
     count_diff_all = 0
@@ -227,6 +229,23 @@ def clear(request):
         return _redirect_back_or_default(request)
 
 
+def _prefetch_cruises(cruise_ids):
+    """Load the cruises and their files so that adding or removing each cruise
+    does not have to.
+
+    """
+    ids = []
+    for cruise_id in cruise_ids:
+        try:
+            ids.append(int(cruise_id))
+        except ValueError:
+            pass
+    if not ids:
+        return
+    Cruise.prefetch_file_attrs(
+        Cruise.query().filter(Cruise.id.in_(ids)).all())
+
+
 def _add_single_cruise(request, cruise_id):
     try:
         cruise_obj = Cruise.query().get(cruise_id)
@@ -329,7 +348,7 @@ def download(request):
 
     def app_iter():
         try:
-            attrs = Change.get_all_by_ids(*ids)
+            attrs = Change.resolve_values(Change.get_all_by_ids(*ids))
 
             zstream = TempFileStreamingZipFile([])
             for attr in attrs:
@@ -148,7 +148,7 @@ def obj_attrs(request):
         raise HTTPNotFound()
 
     if method  == 'GET':
-        return {'obj': obj, 'type': __builtins__['type']}
+        return _obj_attrs_response(request, obj)
 
     if not request.user:
         return require_signin(request)
@@ -192,10 +192,30 @@ def obj_attrs(request):
 
     if change:
         change._notes.append(note)
-    return {'obj': obj, 'type': __builtins__['type']}
+    return _obj_attrs_response(request, obj)
+
+
+def _obj_attrs_response(request, obj):
+    changes, changes_after = keyset_paged(
+        request, lambda after: obj.iter_changes(after=after), 'changes_')
+    Change.resolve_values(changes)
+    return {
+        'obj': obj,
+        'changes': changes,
+        'changes_after': changes_after,
+        'type': __builtins__['type'],
+    }
 
 
 def obj_notes(request):
+    """Return the Obj's notes that the user may see.
+
+    Without paging parameters, all of the notes are returned as a list. If
+    after or items_per_page is given, a page of notes is returned newest first
+    as {'notes': [...], 'after': id}. Continue with the next page by passing
+    the returned after. It is None for the last page.
+
+    """
     method = http_method(request)
 
     obj_id = request.matchdict['obj_id']
@@ -205,8 +225,20 @@ def obj_notes(request):
 
     if method == 'GET':
         if has_mod(request.user):
-            return obj.notes
+            discussion = None
         elif has_edit(request.user):
+            discussion = True
+        else:
+            discussion = False
+        if 'after' in request.params or 'items_per_page' in request.params:
+            notes, after = keyset_paged(
+                request,
+                lambda after: obj.iter_notes(discussion=discussion,
+                                             after=after))
+            return {'notes': notes, 'after': after}
+        if discussion is None:
+            return obj.notes
+        elif discussion:
             return obj.notes_discussion
         else:
             return obj.notes_public
@@ -7,7 +7,7 @@ from pyramid.response import Response
 from pyramid.httpexceptions import HTTPSeeOther, HTTPBadRequest
 
 from pycchdo.models.searchsort import sort_results
-from pycchdo.views.cruise import _cruise_to_json
+from pycchdo.views.cruise import _cruises_to_json
 from pycchdo.log import getLogger, DEBUG
 
 
@@ -63,7 +63,7 @@ def search_results_json(request):
             continue
         for obj, obj_cruises in value.items():
             cruises.extend(obj_cruises)
-    cruise_jsons = map(_cruise_to_json, cruises)
+    cruise_jsons = _cruises_to_json(cruises)
     return {
         'query': query,
         'results': cruise_jsons,
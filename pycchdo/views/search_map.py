@@ -1,10 +1,11 @@
 import datetime
 import os
 import json
-import math
 import time
 import tempfile
 
+import numpy as np
+
 from pyramid.response import Response
 from pyramid.httpexceptions import (
     HTTPNotFound, HTTPBadRequest, HTTPInternalServerError,
@@ -14,12 +15,15 @@ from webhelpers import html as whh
 
 from shapely.ops import unary_union
 from shapely.geometry import (
-    polygon as poly, LineString, Point, box, MultiPolygon,
+    polygon as poly, Point, box, MultiPolygon,
 )
 
 from pycchdo import models, helpers as h
 from pycchdo.models import search
-from pycchdo.models.serial import Cruise, Change, OrderedSet
+from pycchdo.models.serial import Cruise, Change
+from pycchdo.models.tracks import PackedTracks
+from pycchdo.models.tiles import valid_tile
+from pycchdo.util import LRUCache
 from pycchdo.views import file_response
 from pycchdo.log import getLogger, DEBUG
 
@@ -28,53 +32,56 @@ log = getLogger(__name__)
 log.setLevel(DEBUG)
 
 
-RADIUS_EARTH = 6371.01 # km
 DEFAULTS = {
     'max_coords': 50,
     'time_min': 1967,
     'time_max': datetime.date.today().year + 1,
     'roi_result_limit': None,
+    'info_batch_limit': 500,
 }
 
 
-class MapsJSONEncoder(json.JSONEncoder):
-    """ Encodes ObjectIds and floats in a different way
+TRACK_FORMATS = ['coords', 'polyline']
+
+
+# Decimal places kept in track coordinates (about 11 m)
+COORD_PRECISION = 4
+
+
+def round_track(coords, precision=COORD_PRECISION):
+    """Round track coordinates so they serialize short."""
+    return [[round(lng, precision), round(lat, precision)]
+            for lng, lat in (coord[:2] for coord in coords)]
+
 
-    http://stackoverflow.com/questions/1447287/format-floats-with-standard-json-module
+def encode_polyline(coords, precision=5):
+    """Encode a track with the Google encoded polyline algorithm.
 
-    Notes:
-      - _iterecode and _iterencode_dict are lame overrides to allow for
-        float formatting override. Poor design in STL...
-        http://stackoverflow.com/questions/1447287/
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+    coords - a list of [lng, lat]. The encoding is of (lat, lng) pairs.
 
     """
-    FLOAT_FRMT = '{0:.4f}'
-
-    def floatstr(self, obj):
-        return self.FLOAT_FRMT.format(obj)
-
-    def _iterencode(self, obj, markers=None):
-        # stl JSON lame override #1
-        new_obj = obj
-        if isinstance(obj, float):
-            if not math.isnan(obj) and not math.isinf(obj):
-                return self.floatstr(obj)
-        return super(MapsJSONEncoder, self)._iterencode(
-            new_obj, markers=markers)
-
-    def _iterencode_dict(self, dct, markers=None):
-        # stl JSON lame override #2
-        new_dct = {}
-        for key, value in dct.iteritems():
-            if isinstance(key, float):
-                if not math.isnan(key) and not math.isinf(key):
-                    key = self.floatstr(key)
-            new_dct[key] = value
-        return super(MapsJSONEncoder, self)._iterencode_dict(
-            new_dct, markers=markers)
-
-    def default(self, obj):
-        return json.JSONEncoder.default(self, obj)
+    factor = 10 ** precision
+    chars = []
+    prev_lat = prev_lng = 0
+    for coord in coords:
+        lat = int(round(coord[1] * factor))
+        lng = int(round(coord[0] * factor))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                chars.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            chars.append(chr(delta + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(chars)
+
+
+def _json_response(obj):
+    resp = Response(json.dumps(obj, separators=(',', ':')))
+    resp.content_type = 'application/json'
+    return resp
 
 
 def index(request, commands=''):
@@ -98,9 +105,19 @@ def ids(request):
     3. q
         Params:
             - q - a string query
+
+    All ways also take either of the following to pick a track resolution:
+        - max_coords - the preferred maximum number of coordinates per track
+        - zoom - the map zoom level
+    and optionally
+        - track_format - coords (default) for lists of [lng, lat] or polyline
+          for Google encoded polyline strings
     Returns: JSON
         {cruise_id: track_id, ...}
 
+    The infos only have the labels for the results table. The data file
+    listings are requested separately from info().
+
     """
     try:
         req_shapes = request.params.get('shapes', None).split('|')
@@ -116,41 +133,10 @@ def ids(request):
     limited = False
 
     if req_shapes:
-        polygons = []
-        filters = []
-
-        for shape in req_shapes:
-            special, vs = shape.split(':')
-            try:
-                coords = [[float(x) for x in c.split(',')] for c in vs.split('_')]
-            except ValueError:
-                raise HTTPBadRequest()
-
-            if special == 'polygon':
-                filter_func = track_in_polygon
-            elif special == 'rectangle':
-                # Do a rotl-1 to turn nw, se into sw, ne
-                #if coords[0] and coords[2] and coords[0][0] < coords[2][0]:
-                #    coords = coords[1:] + [coords[0]]
-                filter_func = track_in_rectangle
-            elif special == 'circle':
-                filter_func = track_in_polygon
-            else:
-                continue
-            polygon = poly.orient(poly.Polygon(coords))
-
-            # Safe the polygon against the dateline for filtering. This could
-            # be improved by allowing Cruise.cruises_in_selection to operate on
-            # multipolygons and safing those as well.
-            if crosses_dateline(polygon):
-                safepoly0, safepoly1 = split_across_dateline(polygon)
-                polygons.append(safepoly0)
-                polygons.append(safepoly1)
-                filters.append(TrackInChecker(safepoly0, filter_func))
-                filters.append(TrackInChecker(safepoly1, filter_func))
-            else:
-                polygons.append(polygon)
-                filters.append(TrackInChecker(polygon, filter_func))
+        try:
+            selections = _selections(req_shapes)
+        except ValueError:
+            raise HTTPBadRequest()
 
         time_min = int(request.params.get('time_min', DEFAULTS['time_min']))
         # Bump the year forward because we want searches up to 
@@ -160,21 +146,23 @@ def ids(request):
 
         # All geo searches need to be refiltered because MySQL only selects for
         # MaxBoundingRectangleIntersection
-        for polygon, bounds_check in zip(polygons, filters):
-            raw_tracks, limited = getTracksInSelection(polygon, time_min, time_max)
+        for polygon, bounds_check in selections:
+            raw_tracks, limited = getTracksInSelection(
+                request, polygon, time_min, time_max)
             log.debug(u'{0} cruises before filtering'.format(len(raw_tracks)))
-            filtered = filter(
-                lambda t: bounds_check(uniq_track(t.track)), raw_tracks)
+            mask = bounds_check(PackedTracks.from_cruises(raw_tracks))
+            filtered = [
+                cruise for cruise, keep in zip(raw_tracks, mask) if keep]
             log.debug(u'{0} cruises after filtering'.format(len(filtered)))
             cruises.extend(filtered)
     elif req_ids:
-        cruises = [Cruise.get_by_id(id) for id in req_ids]
+        cruises = Cruise.get_by_ids(req_ids)
     elif req_q:
         results = request.search_index.search(request.params.get('q', ''))
         cruises = search.compile_into_cruises(results)
     log.debug(u'{0} cruises found'.format(len(cruises)))
 
-    h.reduce_specificity(cruises)
+    h.reduce_specificity(request, *cruises)
 
     # Build JSON response with id: track
     id_track = {}
@@ -187,13 +175,64 @@ def ids(request):
         id_track[str(c.id)] = tid
         id_cruises.append((c.id, tid, c))
     log.debug('tracks loaded')
-    tracks = _track(id_cruises, request.params.get('max_coords', ''))
+    track_format = request.params.get('track_format', TRACK_FORMATS[0])
+    if track_format not in TRACK_FORMATS:
+        raise HTTPBadRequest()
+    try:
+        tracks = _track(
+            id_cruises, request.params.get('max_coords', ''),
+            request.params.get('zoom', ''), track_format)
+    except ValueError:
+        raise HTTPBadRequest()
     log.debug('tracks entered')
-    infos = _info(request, id_cruises)
+    infos = _labels(id_cruises)
     log.debug('infos entered')
 
-    response = {'id_t': id_track, 'i': infos, 't': tracks, 'limited': limited}
-    resp = Response(json.dumps(response, cls=MapsJSONEncoder))
+    return _json_response(
+        {'id_t': id_track, 'i': infos, 't': tracks, 'limited': limited})
+
+
+def info(request):
+    """Give the full infos for a batch of cruises.
+
+    Params:
+        - ids - the IDs of the cruises to describe
+
+    Returns: JSON
+        {cruise_id: info, ...}
+
+    """
+    try:
+        req_ids = request.params['ids'].split(',')
+    except KeyError:
+        raise HTTPBadRequest()
+    if len(req_ids) > DEFAULTS['info_batch_limit']:
+        raise HTTPBadRequest()
+    try:
+        cruises = Cruise.get_by_ids(req_ids)
+    except ValueError:
+        raise HTTPNotFound()
+
+    h.reduce_specificity(request, *cruises)
+
+    return _json_response(_info(request, [(c.id, None, c) for c in cruises]))
+
+
+def tile(request):
+    """Give a tile of all cruise tracks.
+
+    Returns: GeoJSON
+        A FeatureCollection of the tracks clipped to the tile. Each feature has
+        the cruise id, expocode and year.
+
+    """
+    try:
+        zoom, x, y = [int(request.matchdict[key]) for key in ('z', 'x', 'y')]
+    except ValueError:
+        raise HTTPBadRequest()
+    if not valid_tile(zoom, x, y):
+        raise HTTPNotFound()
+    resp = Response(request.track_tiles.get(zoom, x, y))
     resp.content_type = 'application/json'
     return resp
 
@@ -262,7 +301,7 @@ def layer(request):
     raise HTTPNotFound()
 
 
-def _info_id_cruise(request, cruise):
+def _label_id_cruise(cruise):
     info = {
         'name': cruise.expocode or '',
         'contacts': ', '.join(
@@ -293,7 +332,11 @@ def _info_id_cruise(request, cruise):
     except AttributeError, e:
         print e
         info['ship'] = ''
+    return info
 
+
+def _info_id_cruise(request, cruise):
+    info = _label_id_cruise(cruise)
     data_files = h.collect_data_files(cruise)
     data = h.H.div(
         h.datacart_link_cruise(request, cruise), 
@@ -304,8 +347,20 @@ def _info_id_cruise(request, cruise):
     return info
 
 
+def _labels(id_cruises):
+    labels = {}
+    for id, idt, cruise in id_cruises:
+        id = str(id)
+        try:
+            labels[id] = _label_id_cruise(cruise)
+        except (KeyError, AttributeError) as e:
+            log.warn('Unable to read info for %s %s' % (id, e))
+    return labels
+
+
 def _info(request, id_cruises):
     infos = {}
+    Cruise.prefetch_file_attrs([cruise for id, idt, cruise in id_cruises])
     for id, idt, cruise in id_cruises:
         id = str(id)
         try:
@@ -321,23 +376,98 @@ def _max_coords(max_coords=None):
     return int(DEFAULTS['max_coords'])
 
 
-def _track(id_cruises, max_coords=None):
+def _zoom(zoom=None):
+    if zoom:
+        return int(zoom)
+    return None
+
+
+def _track(id_cruises, max_coords=None, zoom=None, track_format='coords'):
     max_coords = _max_coords(max_coords)
+    tracks = Cruise.simplified_tracks(
+        [id for id, idt, c in id_cruises], max_coords, _zoom(zoom))
+    if track_format == 'polyline':
+        encode = encode_polyline
+    else:
+        encode = round_track
     d = {}
     for id, idt, c in id_cruises:
         try:
-            t = c.track
-            d[idt] = pareDown(t, max_coords)
-        except (KeyError, AttributeError) as e:
-            log.warn('Unable to get track for %s %s' % (id, e))
+            d[idt] = encode(tracks[id])
+        except KeyError:
+            # Simplified tracks have not been built for this cruise yet.
+            try:
+                d[idt] = encode(pareDown(c.track, max_coords))
+            except (KeyError, AttributeError) as e:
+                log.warn('Unable to get track for %s %s' % (id, e))
     return d
 
 
-def getTracksInSelection(selection, time_min, time_max):
-    return Cruise.cruises_in_selection(
+def getTracksInSelection(request, selection, time_min, time_max):
+    return request.track_index.cruises_in_selection(
         selection, (time_min, time_max), DEFAULTS['roi_result_limit'])
 
 
+# Parsed selections by their normalized shapes
+_selection_cache = LRUCache(size=256, ttl=3600)
+
+
+def _normalize_shapes(req_shapes):
+    """Parse the shapes parameter into a hashable form.
+
+    Raises ValueError for shapes that cannot be parsed.
+
+    """
+    shapes = []
+    for shape in req_shapes:
+        special, vs = shape.split(':')
+        coords = tuple(
+            tuple(float(x) for x in c.split(',')) for c in vs.split('_'))
+        shapes.append((special.strip(), coords))
+    return tuple(shapes)
+
+
+def _selections(req_shapes):
+    """Return the selections to search for the shapes parameter.
+
+    Each selection is a tuple of a dateline safe polygon and a bounds check
+    for PackedTracks. Selections are cached by the normalized shapes so
+    repeated queries over the same region skip the geometry setup. Prepared
+    geometries are not thread safe, so they are not part of the cache.
+
+    Raises ValueError for shapes that cannot be parsed.
+
+    """
+    shapes = _normalize_shapes(req_shapes)
+    selections = _selection_cache.get(shapes)
+    if selections is not None:
+        return selections
+
+    selections = []
+    for special, coords in shapes:
+        if special == 'polygon':
+            filter_func = track_in_polygon
+        elif special == 'rectangle':
+            filter_func = track_in_rectangle
+        elif special == 'circle':
+            filter_func = track_in_polygon
+        else:
+            continue
+        polygon = poly.orient(poly.Polygon(coords))
+
+        # Safe the polygon against the dateline for filtering. This could
+        # be improved by allowing Cruise.cruises_in_selection to operate on
+        # multipolygons and safing those as well.
+        if crosses_dateline(polygon):
+            polygons = split_across_dateline(polygon)
+        else:
+            polygons = [polygon]
+        for polygon in polygons:
+            selections.append((polygon, TrackInChecker(polygon, filter_func)))
+    _selection_cache.set(shapes, selections)
+    return selections
+
+
 def pareDown(line, max_coords=50):
     """
     Args:
@@ -350,13 +480,6 @@ def pareDown(line, max_coords=50):
     return [list(line.coords[i]) for i in range(0, l, step_size)]
 
 
-def uniq_track(linestr):
-    uniq_coords = list(OrderedSet(linestr.coords))
-    if len(uniq_coords) == 1:
-        uniq_coords.append(uniq_coords[0])
-    return LineString(uniq_coords)
-
-
 class TrackInChecker(object):
     def __init__(self, shape, func):
         self.shape = shape
@@ -366,63 +489,28 @@ class TrackInChecker(object):
         return self.func(self.shape, track)
 
 
-def in_range(lo, x, hi):
-    """ Tells if x is in the interval [lo, hi) """
-    return lo <= x and x < hi
-
-
-def between_lat(lower, test, upper):
-    return in_range(lower, test, upper) 
-
-
-def between_lng(lower, test, upper):
-    if lower > upper:
-        # crossed the date-line
-        return in_range(lower, test, 180) or in_range(-180, test, upper)
-    return in_range(lower, test, upper)
-
-
-def in_rect(coord, sw, ne):
-    #log.debug('{0} {1} {2}'.format(coord,sw,ne))
-    return (between_lng(sw[0], coord[0], ne[0]) and
-            between_lat(sw[1], coord[1], ne[1]))
-
-
-def track_in_rectangle(rect, track):
+def track_in_rectangle(rect, tracks):
+    """Test PackedTracks for coordinates in the rectangle."""
     # check each point, intersection is weird over the dateline
     ext = rect.exterior.coords
     minx = min(ext[0][0], ext[2][0])
     maxx = max(ext[0][0], ext[2][0])
     miny = min(ext[0][1], ext[2][1])
     maxy = max(ext[0][1], ext[2][1])
-    sw, ne = (minx, miny), (maxx, maxy)
-    return any(in_rect(coord, sw, ne) for coord in track.coords)
-
-
-def _in_circle(pt, center, radius):
-    d = center.ellipsoidal_distance(pt) / 1000
-    return 1 <= d and d < radius
-
-
-def track_in_circle(center, radius, track):
-    return any(_in_circle(coord, center, radius) for coord in track)
+    return tracks.in_rectangle((minx, miny), (maxx, maxy))
 
 
-def in_polygon(poly, pt):
-    # port of a C algorithm
-    # similar http://www.ariel.com.au/a/python-point-int-poly.html
-    l = len(poly)
-    j = l - 1
-    c = False
-    for i in range(0, l):
-        v1 = poly[i]
-        v2 = poly[j]
-        if (((v1[1] > pt[1]) != (v2[1] > pt[1])) and
-            (pt[0] < (v2[0] - v1[0]) * (pt[1] - v1[1]) / (v2[1] - v1[1]) +
-             v1[0])):
-            c = not c
-        j = i
-    return c
+def track_in_polygon(polygon, tracks):
+    """Test PackedTracks for intersection with the (multi)polygon."""
+    try:
+        polygons = polygon.geoms
+    except AttributeError:
+        polygons = [polygon]
+    mask = np.zeros(len(tracks), dtype=bool)
+    for part in polygons:
+        if part.type == 'Polygon':
+            mask |= tracks.in_polygon(list(part.exterior.coords))
+    return mask
 
 
 def crosses_dateline(polygon):
@@ -532,13 +620,3 @@ def safe_shape(polygon):
     return polygon
 
 
-def track_in_polygon(polygon, track):
-    return polygon.intersects(track)
-
-
-def track_in_any_loci(loci, radius, track):
-    def in_any_loci(coord):
-        for locus in loci:
-            if _in_circle(pt, center, radius):
-                return True
-    return any(in_any_loci(coord) for coord in track.coords)
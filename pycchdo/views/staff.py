@@ -790,6 +790,8 @@ def moderation(request):
             dtc_to_q[key] = [change]
 
     dtc = paged(request, sorted(dtc_to_q.keys(), reverse=True))
+    Change.resolve_values(
+        [queued for dkey in dtc for queued in dtc_to_q[dkey]])
 
     return {
         'dtc': dtc,
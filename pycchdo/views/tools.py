@@ -286,8 +286,7 @@ def dumps_sqlite(request):
 
         dac = 'CCHDO'
         profile_type = 'ctd'
-        cruises = Cruise.query().all()
-        h.reduce_specificity(request, *cruises)
+        cruises = h.all_reduced_specificity(request, Cruise.query())
         for c in cruises:
             if any(c.get(format) for format in ctd_formats):
                 cruise = c.uid
@@ -365,8 +364,8 @@ def dumps_sqlite(request):
             'id', 'aliases', 'collections', 'ship', 'country', 'chi_sci', 
             'ports', 'date_start', 'date_end', 'track', ]
 
-        cruises_seahunt = Cruise.only_if_accepted_is(False).all()
-        h.reduce_specificity(request, *cruises_seahunt)
+        cruises_seahunt = h.all_reduced_specificity(
+            request, Cruise.only_if_accepted_is(False))
         for c in cruises_seahunt:
             id = c.uid
             aliases = ', '.join(c.aliases)
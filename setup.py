@@ -36,6 +36,7 @@ _requires_app = [
     'whoosh',
     'geojson',
     'shapely',
+    'numpy',
     'tempfilezipstream>=2.0',
     #'libcchdo>=0.8.2',
     'libcchdo',
@@ -87,6 +88,10 @@ setup(
             'pycchdo_clean_fs = pycchdo.scripts.clean_fs:main',
             ('pycchdo_rebuild_search_index = '
              'pycchdo.scripts.rebuild_search_index:main'),
+            ('pycchdo_rebuild_caches = '
+             'pycchdo.scripts.rebuild_caches:main'),
+            ('pycchdo_search_indexer = '
+             'pycchdo.scripts.search_indexer:main'),
             'pycchdo_import = pycchdo.importer:do_import',
             ('pycchdo_update_param_status_cache = '
              'pycchdo.scripts.update_param_status_cache:main'),